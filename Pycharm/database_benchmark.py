@@ -0,0 +1,59 @@
+import sys
+import shutil
+from pathlib import Path
+from time import perf_counter
+from uuid import uuid4
+
+from lib.database import Database, User, Item
+from lib.email import Email
+from lib.key import Key
+
+# Times the common `Database` operations. Run it before and after changing the
+# database code to see the difference. Writes are usually dominated by the disk
+# syncing each commit, so to compare the queries themselves pass a directory on
+# a RAM disk as the first argument (for example `/dev/shm/benchmark`).
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+DATA_DIR = Path(sys.argv[1] if len(sys.argv) > 1 else f"{SCRIPT_DIR}/__benchmark_data__")
+COUNT = 2000
+
+def bench(name: str, f):
+    start = perf_counter()
+    for i in range(COUNT):
+        f(i)
+    elapsed = perf_counter() - start
+    print(f"{name:<24} {elapsed / COUNT * 1_000_000:8.1f} us/op")
+
+shutil.rmtree(DATA_DIR, ignore_errors=True)
+DATA_DIR.mkdir(parents=True, exist_ok=True)
+db = Database(DATA_DIR.__str__())
+
+emails = [Email(f"user{i}@bench.com") for i in range(COUNT)]
+item_ids = [uuid4() for _ in range(COUNT)]
+user = User(
+    auth_key=Key(1234),
+    private_info=bytes(1024),
+    public_key=Key(5678),
+    messages=[bytes(100)] * 10,
+    description="a user made by the benchmark",
+)
+item = Item(auth_key=Key(1234), contents=bytes(4096), release_keys=[])
+# updates write different values because SQLite skips writing rows that didn't
+# change.
+updated_user = User(
+    auth_key=Key(4321),
+    private_info=bytes([1]) * 1024,
+    public_key=Key(8765),
+    messages=[bytes([1]) * 100] * 10,
+    description="a user updated by the benchmark",
+)
+updated_item = Item(auth_key=Key(4321), contents=bytes([1]) * 4096, release_keys=[])
+
+bench("insert new user", lambda i: db.insert_user(emails[i], user, False))
+bench("update user", lambda i: db.insert_user(emails[i], updated_user, True))
+bench("get user", lambda i: db.get_user(emails[i]))
+bench("insert new item", lambda i: db.insert_item(item_ids[i], item, False))
+bench("update item", lambda i: db.insert_item(item_ids[i], updated_item, True))
+bench("get item", lambda i: db.get_item(item_ids[i]))
+
+shutil.rmtree(DATA_DIR, ignore_errors=True)
@@ -1,10 +1,12 @@
 import shutil
 import os
+import sqlite3
 from pathlib import Path
 from uuid import uuid4
 from datetime import datetime
+from time import time
 
-from lib.database import Database, User, Item, ReleaseKey
+from lib.database import Database, User, Item, ReleaseKey, PublicUserInfo, OutOfRangeError
 from lib.email import Email
 from lib.key import Key
 
@@ -98,3 +100,110 @@ db.insert_item(item_id2, item1, True)
 assert_eq(db.get_item(item_id2), item1)
 db.insert_item(item_id2, item2, True)
 assert_eq(db.get_item(item_id2), item2)
+
+db.add_message(user_email1, b"new message")
+assert_eq(db.get_user(user_email1).messages, user2.messages + [b"new message"])
+assert_panic(lambda: db.add_message(Email("nobody@cohen.com"), b"new message"))
+
+db.update_user_data(user_email1, b"new private info", [b"kept message"])
+db.add_message(user_email1, b"new message")
+assert_eq(db.get_user(user_email1), User(
+    auth_key=user2.auth_key,
+    private_info=b"new private info",
+    public_key=user2.public_key,
+    messages=[b"kept message", b"new message"],
+    description=user2.description,
+))
+assert_panic(lambda: db.update_user_data(Email("nobody@cohen.com"), b"", []))
+
+assert_eq(db.get_user_directory(), [
+    PublicUserInfo(email=user_email1, description=user2.description, public_key=user2.public_key),
+    PublicUserInfo(email=user_email2, description=user2.description, public_key=user2.public_key),
+])
+
+assert_eq(db.get_item_contents_size(item_id1), len(item2.contents))
+assert_eq(db.read_item_contents(item_id1, 3, 10), (item2.contents[3:13], len(item2.contents)))
+assert_eq(db.read_item_contents(item_id1, 0, len(item2.contents)), (item2.contents, len(item2.contents)))
+assert_panic(lambda: db.read_item_contents(item_id1, 3, len(item2.contents)))
+try:
+    db.read_item_contents(item_id1, 3, len(item2.contents))
+except OutOfRangeError as e:
+    assert_eq(e.size, len(item2.contents))
+assert_panic(lambda: db.read_item_contents(item_id1, -1, 2))
+assert_panic(lambda: db.read_item_contents(uuid4(), 0, 0))
+db.write_item_contents(item_id1, 5, b"\x00\xff\x00")
+assert_eq(db.get_item(item_id1).contents, item2.contents[:5] + b"\x00\xff\x00" + item2.contents[8:])
+assert_panic(lambda: db.write_item_contents(item_id1, len(item2.contents) - 1, b"ab"))
+db.append_item_contents(item_id2, b"\x00\xc3appended")
+assert_eq(db.get_item(item_id2).contents, item2.contents + b"\x00\xc3appended")
+assert_eq(db.get_item(item_id2).release_keys, item2.release_keys)
+assert_panic(lambda: db.append_item_contents(uuid4(), b"appended"))
+
+assert_eq(db.get_private_info_size(user_email2), len(user2.private_info))
+assert_eq(db.read_private_info(user_email2, 2, 4), (user2.private_info[2:6], len(user2.private_info)))
+db.write_private_info(user_email2, 0, b"ab")
+assert_eq(db.get_user(user_email2).private_info, b"ab" + user2.private_info[2:])
+assert_panic(lambda: db.write_private_info(user_email2, 0, user2.private_info + b"a"))
+
+BACKUP_DIR = Path(f"{SCRIPT_DIR}/__backup__")
+shutil.rmtree(BACKUP_DIR,ignore_errors=True)
+BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+backup_progress = []
+db.backup(BACKUP_DIR.__str__(), pages_per_step=1, step_delay=0, progress=lambda copied, total: backup_progress.append((copied, total)))
+assert_eq(backup_progress[-1][0], backup_progress[-1][1])
+assert_eq(len(backup_progress), backup_progress[-1][1])
+backup_db = Database(BACKUP_DIR.__str__())
+assert_eq(backup_db.get_user(user_email1), db.get_user(user_email1))
+assert_eq(backup_db.get_item(item_id2), db.get_item(item_id2))
+shutil.rmtree(BACKUP_DIR,ignore_errors=True)
+
+# the delay is slept between every two steps.
+BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+backup_start = time()
+db.backup(BACKUP_DIR.__str__(), pages_per_step=1, step_delay=0.02)
+assert_eq(time() - backup_start >= 0.02 * (len(backup_progress) - 1), True)
+shutil.rmtree(BACKUP_DIR,ignore_errors=True)
+
+# a failed backup leaves nothing behind.
+BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+def failing_progress(copied: int, total: int):
+    if copied > 1:
+        raise RuntimeError("stop")
+assert_panic(lambda: db.backup(BACKUP_DIR.__str__(), pages_per_step=1, step_delay=0, progress=failing_progress))
+assert_eq(os.listdir(BACKUP_DIR), [])
+shutil.rmtree(BACKUP_DIR,ignore_errors=True)
+
+large_item_id = uuid4()
+db.insert_item(large_item_id, Item(auth_key=item1.auth_key, contents=bytes(1024 * 1024), release_keys=[]), False)
+db.remove_item(large_item_id)
+stats = db.get_storage_stats()
+assert_eq(stats.free_page_count > 0, True)
+assert_eq(db.get_free_page_count(), stats.free_page_count)
+assert_eq(db.incremental_vacuum(10), 10)
+assert_eq(db.get_storage_stats().free_page_count, stats.free_page_count - 10)
+while db.incremental_vacuum(64) > 0:
+    pass
+assert_eq(db.get_storage_stats().free_page_count, 0)
+assert_eq(db.get_storage_stats().page_count < stats.page_count, True)
+db.checkpoint()
+assert_eq(db.get_storage_stats().file_size < stats.file_size, True)
+db.optimize()
+db.analyze()
+assert_eq(db.get_user(user_email1).description, user2.description)
+
+# databases created before incremental vacuum was used are migrated.
+OLD_DATA_DIR = Path(f"{SCRIPT_DIR}/__old_data__")
+shutil.rmtree(OLD_DATA_DIR,ignore_errors=True)
+OLD_DATA_DIR.mkdir(parents=True, exist_ok=True)
+old_conn = sqlite3.connect(f"{OLD_DATA_DIR}/.sqlite")
+old_conn.execute("CREATE TABLE users (email TEXT PRIMARY KEY, auth_key BLOB, private_info BLOB, public_key BLOB, messages BLOB)")
+old_conn.execute("CREATE TABLE items (id TEXT PRIMARY KEY, auth_key BLOB, contents BLOB, release_keys BLOB)")
+old_conn.execute("CREATE TABLE user_descriptions (email TEXT PRIMARY KEY REFERENCES users(email) ON DELETE CASCADE, description TEXT)")
+old_conn.commit()
+assert_eq(old_conn.execute("PRAGMA auto_vacuum").fetchone()[0], 0)
+old_conn.close()
+old_db = Database(OLD_DATA_DIR.__str__())
+old_conn = sqlite3.connect(f"{OLD_DATA_DIR}/.sqlite")
+assert_eq(old_conn.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+old_conn.close()
+shutil.rmtree(OLD_DATA_DIR,ignore_errors=True)
@@ -0,0 +1,439 @@
+import random
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from threading import Condition
+from time import time
+from weakref import WeakKeyDictionary
+
+from .socket_wrapper import ClientConnection, try_connect_to_server
+from .request_response import (
+    Request,
+    Response,
+    SignupRequest,
+    SignupResponse,
+    LoginRequest,
+    LoginResponse,
+    FetchRequest,
+    FetchResponse,
+    PushRequest,
+    PushResponse,
+    SendRequest,
+    SendResponse,
+    ItemRequest,
+    ItemResponse,
+    CreateItemRequest,
+    CreateItemResponse,
+    EncryptItemRequest,
+    EncryptItemResponse,
+    ReleaseItemRequest,
+    ReleaseItemResponse,
+    ItemRangeRequest,
+    ItemRangeResponse,
+    WriteItemRangeRequest,
+    WriteItemRangeResponse,
+    AppendItemRequest,
+    AppendItemResponse,
+    PrivateInfoRangeRequest,
+    PrivateInfoRangeResponse,
+    WritePrivateInfoRangeRequest,
+    WritePrivateInfoRangeResponse,
+    SubscribeRequest,
+    SubscribeResponse,
+    NewMessagesNotification,
+)
+
+# Seconds a request may take (including getting a connection) before it fails.
+REQUEST_TIMEOUT = 10.0
+# Requests that don't change anything on the server, so sending them twice is
+# harmless.
+_READ_ONLY_REQUESTS = (LoginRequest, FetchRequest, ItemRequest, ItemRangeRequest, PrivateInfoRangeRequest)
+
+# Raised when a connection was lost before a request was sent, so the server
+# never got it.
+class _NotSentError(ConnectionError):
+    pass
+
+# How long to wait between failed attempts to connect to the server.
+@dataclass
+class ReconnectPolicy:
+    # the longest possible delay after the first failure.
+    base_delay: float = 0.1
+    # the delay never grows past this.
+    max_delay: float = 10.0
+    # how much the longest possible delay grows after each failure.
+    multiplier: float = 2.0
+
+    # Returns how long to wait after `failures` failed attempts in a row. The
+    # delay is random between 0 and the exponential limit so that many clients
+    # that lost the server at the same time don't all come back at once.
+    def delay(self, failures: int) -> float:
+        if failures <= 0:
+            return 0.0
+
+        limit = min(self.max_delay, self.base_delay * self.multiplier ** (failures - 1))
+        return random.uniform(0, limit)
+
+class ConnectionPool:
+    """
+    A small set of persistent connections to the server that can be shared by
+    multiple threads.
+
+    Each connection is only used by one thread at a time (see `connection`).
+    Connections are created when needed, up to `max_size`, and failed attempts
+    to connect are spaced out by the `ReconnectPolicy`, no matter how many
+    threads are waiting.
+    """
+
+    _max_size: int
+    _policy: ReconnectPolicy
+    _idle: list[ClientConnection]
+    _size: int
+    _failures: int
+    _retry_at: float
+    _is_connecting: bool
+    _is_closed: bool
+    _condition: Condition
+
+    def __init__(self, max_size: int = 4, policy: ReconnectPolicy | None = None):
+        self._max_size = max_size
+        self._policy = policy if policy is not None else ReconnectPolicy()
+        self._idle = []
+        self._size = 0
+        self._failures = 0
+        self._retry_at = 0.0
+        self._is_connecting = False
+        self._is_closed = False
+        self._condition = Condition()
+
+    def acquire(self, timeout: float) -> ClientConnection:
+        """
+        Takes a connection out of the pool, connecting if needed. Raises
+        `TimeoutError` if no connection was available within `timeout` seconds,
+        and `ConnectionError` if the pool was closed.
+
+        The connection must be given back using `release`.
+        """
+
+        deadline = time() + timeout
+        while True:
+            with self._condition:
+                while True:
+                    if self._is_closed:
+                        raise ConnectionError("the connection pool is closed")
+
+                    while self._idle:
+                        conn = self._idle.pop()
+                        # finds out if the server closed the connection while it
+                        # wasn't used, like when the server restarted. anything
+                        # else that arrived is a late response to an old request.
+                        conn.fill_buffer()
+                        if not conn.is_closed and not conn.has_message():
+                            return conn
+                        self._drop(conn)
+
+                    now = time()
+                    # only one thread connects at a time so a server that's down
+                    # doesn't get a connection attempt from every waiting thread.
+                    can_connect = self._size < self._max_size and not self._is_connecting
+                    if can_connect and now >= self._retry_at:
+                        break
+
+                    wait_until = deadline
+                    if can_connect:
+                        wait_until = min(deadline, self._retry_at)
+                    if now >= deadline:
+                        raise TimeoutError("couldn't get a connection to the server")
+
+                    self._condition.wait(wait_until - now)
+
+                self._is_connecting = True
+                self._size += 1
+
+            conn = try_connect_to_server(max(deadline - time(), 0.0))
+
+            with self._condition:
+                self._is_connecting = False
+                self._condition.notify_all()
+                if conn is not None and self._is_closed:
+                    self._drop(conn)
+                    raise ConnectionError("the connection pool is closed")
+                if conn is not None:
+                    self._failures = 0
+                    self._retry_at = 0.0
+                    return conn
+
+                self._size -= 1
+                self._failures += 1
+                self._retry_at = time() + self._policy.delay(self._failures)
+
+    def release(self, conn: ClientConnection):
+        """
+        Gives a connection taken by `acquire` back to the pool. Closed
+        connections, and every connection once the pool is closed, are thrown
+        away.
+        """
+
+        with self._condition:
+            if conn.is_closed or self._is_closed:
+                self._drop(conn)
+            else:
+                self._idle.append(conn)
+            self._condition.notify()
+
+    def detach(self, conn: ClientConnection):
+        """
+        Makes a connection taken by `acquire` no longer part of the pool. The
+        caller is responsible for closing it.
+        """
+
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self, timeout: float):
+        """
+        `acquire` and `release` in a `with` statement.
+        """
+
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """
+        Closes the connections that aren't in use. Connections that are in use
+        are closed when they are released.
+        """
+
+        with self._condition:
+            self._is_closed = True
+            for conn in self._idle:
+                conn.close()
+            self._size -= len(self._idle)
+            self._idle.clear()
+            self._condition.notify_all()
+
+    def _drop(self, conn: ClientConnection):
+        conn.close()
+        self._size -= 1
+
+class Subscription:
+    """
+    A connection that is told when messages are sent to the logged in user.
+    Created by `ServerClient::subscribe`.
+
+    This class should not be used from two or more threads at the same time.
+    """
+
+    _conn: ClientConnection
+
+    def __init__(self, conn: ClientConnection):
+        self._conn = conn
+
+    def wait(self, timeout: float) -> int:
+        """
+        Blocks until messages are sent to the user or `timeout` seconds have
+        passed. Returns how many messages were sent, 0 if none were.
+
+        Raises `ConnectionError` if the connection was lost, in which case a new
+        subscription should be made.
+        """
+
+        notification = self._conn.recv(timeout)
+        if notification is None and self._conn.is_closed:
+            raise ConnectionError("the subscription was disconnected")
+
+        # notifications that already arrived are counted together.
+        count = 0
+        while notification is not None:
+            if not isinstance(notification, NewMessagesNotification):
+                self._conn.close()
+                raise RuntimeError(f"expected NewMessagesNotification but got {notification.type}")
+
+            count += notification.count
+            notification = self._conn.recv()
+
+        return count
+
+    def close(self):
+        self._conn.close()
+
+class ServerClient:
+    """
+    The client side API of the server.
+
+    Every method sends a single request and blocks until the response arrives.
+    A method raises `TimeoutError` if the server didn't respond within
+    `timeout` seconds. Its safe to call methods from multiple threads at the
+    same time.
+    """
+
+    _pool: ConnectionPool
+    _timeout: float
+    _login: LoginRequest | None
+    # the login request each connection was logged in with.
+    _logged_in: WeakKeyDictionary
+
+    def __init__(self, pool: ConnectionPool | None = None, timeout: float = REQUEST_TIMEOUT):
+        self._pool = pool if pool is not None else ConnectionPool()
+        self._timeout = timeout
+        self._login = None
+        self._logged_in = WeakKeyDictionary()
+
+    def signup(self, email: str, auth_key: int, public_key: bytes) -> SignupResponse:
+        return self._request(
+            SignupRequest(type="SignupRequest", email=email, auth_key=auth_key, public_key=public_key),
+            SignupResponse,
+        )
+
+    # Logs in. The login is remembered and connections that are created later
+    # log in again automatically before sending anything else.
+    def login(self, email: str, auth_key: int) -> LoginResponse:
+        request = LoginRequest(type="LoginRequest", email=email, auth_key=auth_key)
+        response = self._request(request, LoginResponse)
+        if response.is_succees:
+            self._login = request
+
+        return response
+
+    def fetch(self) -> FetchResponse:
+        return self._request(FetchRequest(type="FetchRequest"), FetchResponse)
+
+    def push(self, private_info: bytes, messages: list[bytes]) -> PushResponse:
+        return self._request(PushRequest(type="PushRequest", private_info=private_info, messages=messages), PushResponse)
+
+    def send(self, target_email: str, content: bytes) -> SendResponse:
+        return self._request(SendRequest(type="SendRequest", target_email=target_email, content=content), SendResponse)
+
+    def get_item(self, id: bytes, auth_key: int) -> ItemResponse:
+        return self._request(ItemRequest(type="ItemRequest", id=id, auth_key=auth_key), ItemResponse)
+
+    def create_item(self, contents: bytes, auth_key: int) -> CreateItemResponse:
+        return self._request(CreateItemRequest(type="CreateItemRequest", contents=contents, auth_key=auth_key), CreateItemResponse)
+
+    def encrypt_item(self, id: bytes, auth_key: int, public_key: bytes, prefix: bytes) -> EncryptItemResponse:
+        return self._request(
+            EncryptItemRequest(type="EncryptItemRequest", id=id, auth_key=auth_key, public_key=public_key, prefix=prefix),
+            EncryptItemResponse,
+        )
+
+    def release_item(self, id: bytes, auth_key: int, info: bytes, expires: datetime) -> ReleaseItemResponse:
+        return self._request(
+            ReleaseItemRequest(type="ReleaseItemRequest", id=id, auth_key=auth_key, info=info, expires=expires),
+            ReleaseItemResponse,
+        )
+
+    def get_item_range(self, id: bytes, auth_key: int, offset: int, length: int) -> ItemRangeResponse:
+        return self._request(
+            ItemRangeRequest(type="ItemRangeRequest", id=id, auth_key=auth_key, offset=offset, length=length),
+            ItemRangeResponse,
+        )
+
+    def write_item_range(self, id: bytes, auth_key: int, offset: int, data: bytes) -> WriteItemRangeResponse:
+        return self._request(
+            WriteItemRangeRequest(type="WriteItemRangeRequest", id=id, auth_key=auth_key, offset=offset, data=data),
+            WriteItemRangeResponse,
+        )
+
+    def append_item(self, id: bytes, auth_key: int, data: bytes) -> AppendItemResponse:
+        return self._request(AppendItemRequest(type="AppendItemRequest", id=id, auth_key=auth_key, data=data), AppendItemResponse)
+
+    def get_private_info_range(self, offset: int, length: int) -> PrivateInfoRangeResponse:
+        return self._request(
+            PrivateInfoRangeRequest(type="PrivateInfoRangeRequest", offset=offset, length=length),
+            PrivateInfoRangeResponse,
+        )
+
+    def write_private_info_range(self, offset: int, data: bytes) -> WritePrivateInfoRangeResponse:
+        return self._request(
+            WritePrivateInfoRangeRequest(type="WritePrivateInfoRangeRequest", offset=offset, data=data),
+            WritePrivateInfoRangeResponse,
+        )
+
+    # Returns a subscription that is told about new messages sent to the
+    # logged in user, which is cheaper than calling `fetch` repeatedly. The
+    # subscription uses its own connection. Must be called after a successful
+    # `login`.
+    def subscribe(self) -> Subscription:
+        login = self._login
+        if login is None:
+            raise RuntimeError("must log in before subscribing")
+
+        deadline = time() + self._timeout
+        conn = self._pool.acquire(self._timeout)
+        self._pool.detach(conn)
+        try:
+            if self._logged_in.get(conn) is not login:
+                login_response = self._exchange(conn, login, LoginResponse, deadline)
+                if not login_response.is_succees:
+                    raise RuntimeError("failed to log in again after reconnecting")
+
+            response = self._exchange(conn, SubscribeRequest(type="SubscribeRequest"), SubscribeResponse, deadline)
+            if not response.is_success:
+                raise RuntimeError("the server refused the subscription")
+        except:
+            conn.close()
+            raise
+
+        return Subscription(conn)
+
+    def close(self):
+        self._pool.close()
+
+    def _request(self, request: Request, response_type: type) -> Response:
+        deadline = time() + self._timeout
+        try:
+            return self._request_once(request, response_type, deadline)
+        except ConnectionError as e:
+            # the server may have closed the connection after `acquire` checked
+            # it, so the request gets one more try on another connection. A
+            # request that was sent may have been done before the connection
+            # was lost, so only requests that can't be done twice are retried.
+            if not isinstance(e, _NotSentError) and not isinstance(request, _READ_ONLY_REQUESTS):
+                raise
+            return self._request_once(request, response_type, deadline)
+
+    def _request_once(self, request: Request, response_type: type, deadline: float) -> Response:
+        with self._pool.connection(max(deadline - time(), 0.0)) as conn:
+            login = self._login
+            needs_login = not isinstance(request, (SignupRequest, LoginRequest))
+            if needs_login and login is not None and self._logged_in.get(conn) is not login:
+                try:
+                    login_response = self._exchange(conn, login, LoginResponse, deadline)
+                except ConnectionError as e:
+                    raise _NotSentError(f"the connection was lost before sending {request.type}") from e
+                if not login_response.is_succees:
+                    raise RuntimeError("failed to log in again after reconnecting")
+                self._logged_in[conn] = login
+
+            response = self._exchange(conn, request, response_type, deadline)
+            if isinstance(request, LoginRequest) and response.is_succees:
+                self._logged_in[conn] = request
+
+            return response
+
+    def _exchange(self, conn: ClientConnection, request: Request, response_type: type, deadline: float) -> Response:
+        if conn.is_closed:
+            raise _NotSentError(f"the connection was lost before sending {request.type}")
+        try:
+            conn.send(request)
+        except ConnectionError as e:
+            raise _NotSentError(f"the connection was lost while sending {request.type}") from e
+        response = conn.recv(max(deadline - time(), 0.0))
+        if response is None and conn.is_closed:
+            raise ConnectionError(f"the server closed the connection before responding to {request.type}")
+        if response is None:
+            # a late response would be mistaken for the response of the next
+            # request, so the connection can't be used again.
+            conn.close()
+            raise TimeoutError(f"no response to {request.type}")
+
+        if not isinstance(response, response_type):
+            conn.close()
+            raise RuntimeError(f"expected {response_type.__name__} but got {response.type}")
+
+        return response
@@ -0,0 +1,220 @@
+from time import time
+from select import select
+from socket import socket, socketpair
+from typing import Callable
+
+from .socket_wrapper import ServerListener
+from .request_handler import Client
+
+# `select` can't watch file descriptors above 1024 on most systems so the
+# default stays well below that.
+MAX_CONNECTIONS = 512
+# Seconds a client may stay connected without sending or receiving anything.
+IDLE_TIMEOUT = 300.0
+# The maximum amount of received bytes all clients may hold together. Each
+# connection is also limited by `MAX_BUFFERED_SIZE` from `socket_wrapper`, but
+# that alone would let `MAX_CONNECTIONS` clients hold gigabytes.
+MAX_TOTAL_BUFFERED_SIZE = 256 * 1024 * 1024
+
+class ConnectionManager:
+    """
+    Keeps track of the clients that are connected to the server.
+
+    Clients are stored by the file descriptor of their socket so adding and
+    removing a client doesn't depend on the amount of other clients.
+    Disconnected and idle clients are removed by `reap`. Subscribed clients
+    (see `SubscribeRequest`) are never considered idle. When all clients
+    together hold more than `max_total_buffered_size` received bytes, the ones
+    holding the most are disconnected.
+
+    This class should only be used from the server's main thread, except for
+    `wake`.
+    """
+
+    _listener: ServerListener
+    _clients: dict[int, Client]
+    _max_connections: int
+    _idle_timeout: float
+    _max_total_buffered_size: int
+    _on_remove: Callable[[Client], None] | None
+    _wake_reader: socket
+    _wake_writer: socket
+
+    def __init__(
+        self,
+        listener: ServerListener,
+        max_connections: int = MAX_CONNECTIONS,
+        idle_timeout: float = IDLE_TIMEOUT,
+        max_total_buffered_size: int = MAX_TOTAL_BUFFERED_SIZE,
+        on_remove: Callable[[Client], None] | None = None,
+    ):
+        self._listener = listener
+        self._clients = {}
+        self._max_connections = max_connections
+        self._idle_timeout = idle_timeout
+        self._max_total_buffered_size = max_total_buffered_size
+        # called with every client that is removed.
+        self._on_remove = on_remove
+        self._wake_reader, self._wake_writer = socketpair()
+        self._wake_reader.setblocking(False)
+        self._wake_writer.setblocking(False)
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    @property
+    def buffered_size(self) -> int:
+        """
+        The amount of received bytes held by all connections together.
+        """
+
+        return sum(client.conn.buffered_size for client in self._clients.values())
+
+    def accept_all(self, max_count: int = 50) -> int:
+        """
+        Accepts up to `max_count` waiting connections and returns how many were
+        accepted.
+
+        When the server is full, waiting connections are accepted and closed
+        right away so the peer finds out immediately instead of waiting in the
+        listen queue.
+        """
+
+        accepted = 0
+        for _ in range(max_count):
+            conn = self._listener.accept()
+            if conn is None:
+                break
+
+            if len(self._clients) >= self._max_connections:
+                conn.close()
+                continue
+
+            client = Client(conn)
+            # the file descriptor of a socket that was closed without `remove`
+            # can be given to a new socket right away.
+            old_client = self._clients.get(client.fd)
+            if old_client is not None:
+                self.remove(old_client)
+            self._clients[client.fd] = client
+            accepted += 1
+
+        return accepted
+
+    def wake(self):
+        """
+        Makes a running or the next call to `poll` return right away. Call this
+        from any thread when a client stops being busy, because `poll` doesn't
+        watch busy clients.
+        """
+
+        try:
+            self._wake_writer.send(b"\0")
+        except BlockingIOError:
+            # the buffer is full so `poll` will wake up anyway.
+            pass
+
+    def poll(self, timeout: float) -> list[Client]:
+        """
+        Waits up to `timeout` seconds for something to happen and returns the
+        clients that have a whole request waiting to be handled.
+
+        New connections are accepted as part of this and clients that
+        disconnected are removed. Busy clients are never returned.
+        """
+
+        # closed clients can't be passed to `select`, they are removed by `reap`.
+        idle_clients = [
+            client
+            for client in self._clients.values()
+            if not client.is_busy and not client.conn.is_closed
+        ]
+
+        # a client may have received more than one request at once, in which
+        # case there is no reason to wait for the socket.
+        ready = [client for client in idle_clients if client.conn.has_message()]
+        if ready:
+            timeout = 0
+
+        readable, _, _ = select(
+            [self._listener, self._wake_reader] + [client.conn for client in idle_clients],
+            [],
+            [],
+            timeout,
+        )
+
+        for r in readable:
+            if r is self._listener:
+                self.accept_all()
+                continue
+            if r is self._wake_reader:
+                try:
+                    while self._wake_reader.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+
+            client = self._clients[r.fileno()]
+            client.conn.fill_buffer()
+            if client.conn.is_closed:
+                self.remove(client)
+            elif client.conn.has_message() and client not in ready:
+                ready.append(client)
+
+        if self._limit_buffered_size():
+            ready = [client for client in ready if not client.conn.is_closed]
+
+        return ready
+
+    def reap(self) -> int:
+        """
+        Removes clients that disconnected or didn't do anything for longer than
+        the idle timeout. Returns the amount of removed clients.
+        """
+
+        now = time()
+        dead = [
+            client
+            for client in self._clients.values()
+            if not client.is_busy and (
+                client.conn.is_closed
+                or (not client.is_subscribed and now - client.conn.last_activity > self._idle_timeout)
+            )
+        ]
+
+        for client in dead:
+            self.remove(client)
+
+        return len(dead)
+
+    def _limit_buffered_size(self) -> bool:
+        # returns `True` if clients were removed.
+        total = self.buffered_size
+        if total <= self._max_total_buffered_size:
+            return False
+
+        # busy clients are skipped because their connection belongs to a
+        # worker thread.
+        candidates = [client for client in self._clients.values() if not client.is_busy]
+        candidates.sort(key=lambda client: client.conn.buffered_size, reverse=True)
+        for client in candidates:
+            if total <= self._max_total_buffered_size:
+                break
+
+            total -= client.conn.buffered_size
+            self.remove(client)
+
+        return True
+
+    def remove(self, client: Client):
+        """
+        Closes the client's connection and forgets about it. Does nothing if
+        the client was already removed.
+        """
+
+        if self._clients.get(client.fd) is client:
+            del self._clients[client.fd]
+            if self._on_remove is not None:
+                self._on_remove(client)
+        client.conn.close()
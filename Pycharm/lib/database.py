@@ -1,13 +1,24 @@
+import os
 import sqlite3
 import pickle
 from dataclasses import dataclass
 from datetime import datetime
 from threading import Lock
+from time import sleep
+from typing import Callable
 from uuid import UUID as Uuid
 
 from lib.key import Key
 from lib.email import Email
 
+# How many prepared statements the connection keeps. This is more than the
+# amount of different queries `Database` runs.
+STATEMENT_CACHE_SIZE = 64
+# The default amount of pages `Database::backup` copies at a time.
+BACKUP_PAGES_PER_STEP = 1024
+# The value of `PRAGMA auto_vacuum` when its set to `INCREMENTAL`.
+AUTO_VACUUM_INCREMENTAL = 2
+
 # Information stored about each user in the database. This type only contains
 # data and is not a database handle.
 @dataclass
@@ -56,17 +67,66 @@ class Item:
     # a list of the item's release keys (read the docs for `ReleaseKey`).
     release_keys: list[ReleaseKey]
 
+# The information about a user that is visible to all other users. This type
+# only contains data and is not a database handle.
+@dataclass
+class PublicUserInfo:
+    email: Email
+    # See `User::description`.
+    description: str
+    # See `User::public_key`.
+    public_key: Key
+
+# Information about the size of the database file. This type only contains
+# data.
+@dataclass
+class StorageStats:
+    # The size of the database files in bytes, including the write-ahead log.
+    file_size: int
+    page_size: int
+    page_count: int
+    # Pages that are part of the file but don't store anything, like the pages
+    # of removed items. `Database::incremental_vacuum` gives them back to the
+    # file system.
+    free_page_count: int
+
+    # The part of the file that isn't used, between 0 and 1.
+    @property
+    def fragmentation(self) -> float:
+        if self.page_count == 0:
+            return 0.0
+
+        return self.free_page_count / self.page_count
+
 # A handle to the database. Do not create multiple instances of this type at the
 # same time. You can safely call methods of this type from multiple threads at
 # the same time.
+# The panic of the blob range functions of `Database` when a range isn't inside
+# the blob.
+class OutOfRangeError(IndexError):
+    # The size of the whole blob, so the caller can tell what ranges exist.
+    size: int
+
+    def __init__(self, message: str, size: int):
+        super().__init__(message)
+        self.size = size
+
 class Database:
     def __init__(self, data_dir: str):
         self._data_dir = data_dir
         
         sqlite_path = f"{self._data_dir}/.sqlite"
-        self._conn = sqlite3.connect(sqlite_path)
+        # the connection is shared by all threads and guarded by `_lock`. Every
+        # query is a constant string so SQLite only prepares it once, and the
+        # prepared statement is reused by all threads.
+        self._conn = sqlite3.connect(sqlite_path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
         self._conn.row_factory = sqlite3.Row
         self._conn.execute("PRAGMA foreign_keys = ON;")
+        # lets `incremental_vacuum` give unused pages back to the file system.
+        # This only affects new databases, older ones are migrated below.
+        self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        # with write-ahead logging, readers (like `backup`) don't block writes.
+        self._conn.execute("PRAGMA journal_mode = WAL;")
         self._cursor = self._conn.cursor()
 
         is_new_database = not self._cursor.execute(
@@ -104,6 +164,11 @@ class Database:
                 """
             )
             self._conn.commit()
+        elif self._cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            # the auto vacuum mode of an existing database only changes when the
+            # whole file is rebuilt. This happens once and may take a while for
+            # a large database.
+            self._conn.execute("VACUUM")
 
         self._lock = Lock()
     
@@ -111,33 +176,45 @@ class Database:
     # doesn't, or the opposite) the database is kept as it was before and the
     # function panics.
     def insert_user(self, email: Email, value: User, should_already_exist: bool):
+        values = (
+            email.string,
+            value.auth_key.value.to_bytes(32),
+            value.private_info,
+            value.public_key.value.to_bytes(32),
+            pickle.dumps(value.messages),
+        )
+
         with self._lock:
+            # the existence check is part of the statement, which returns a row
+            # only if it changed something. An existing row is updated in place
+            # so the description isn't deleted by the `ON DELETE CASCADE`.
+            if should_already_exist:
+                self._cursor.execute(
+                    """
+                    UPDATE users SET auth_key = ?2, private_info = ?3, public_key = ?4, messages = ?5
+                    WHERE email = ?1 RETURNING email
+                    """,
+                    values,
+                )
+            else:
+                self._cursor.execute(
+                    """
+                    INSERT INTO users (email, auth_key, private_info, public_key, messages) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (email) DO NOTHING RETURNING email
+                    """,
+                    values,
+                )
+            if not self._cursor.fetchall():
+                self._conn.rollback()
+                if should_already_exist:
+                    raise Exception(f"user {email} doesn't exist")
+                else:
+                    raise Exception(f"user {email} already exists")
+
             self._cursor.execute(
                 """
-                SELECT auth_key FROM users WHERE email = ?
-                """,
-                (email.string,),
-            )
-            if should_already_exist and self._cursor.fetchone() is None:
-                raise Exception(f"user {email} doesn't exist")
-            elif not should_already_exist and self._cursor.fetchone() is not None:
-                raise Exception(f"user {email} already exists")
-            
-            self._cursor.execute(
-                """
-                INSERT OR REPLACE INTO users (email, auth_key, private_info, public_key, messages) VALUES (?, ?, ?, ?, ?)
-                """,
-                (
-                    email.string,
-                    value.auth_key.value.to_bytes(32),
-                    value.private_info,
-                    value.public_key.value.to_bytes(32),
-                    pickle.dumps(value.messages),
-                ),
-            )
-            self._cursor.execute(
-                """
-                INSERT OR REPLACE INTO user_descriptions (email, description) VALUES (?, ?)
+                INSERT INTO user_descriptions (email, description) VALUES (?, ?)
+                ON CONFLICT (email) DO UPDATE SET description = excluded.description
                 """,
                 (
                     email.string,
@@ -150,29 +227,38 @@ class Database:
     # doesn't, or the opposite) the database is kept as it was before and the
     # function panics.
     def insert_item(self, id: Uuid, value: Item, should_already_exist: bool):
+        values = (
+            id.bytes,
+            value.auth_key.value.to_bytes(32),
+            value.contents,
+            pickle.dumps(value.release_keys),
+        )
+
         with self._lock:
-            self._cursor.execute(
-                """
-                SELECT auth_key FROM items WHERE id = ?
-                """,
-                (id.bytes,),
-            )
-            if should_already_exist and self._cursor.fetchone() is None:
-                raise Exception(f"item {id} doesn't exist")
-            elif not should_already_exist and self._cursor.fetchone() is not None:
-                raise Exception(f"item {id} already exists")
-            
-            self._cursor.execute(
-                """
-                INSERT OR REPLACE INTO items (id, auth_key, contents, release_keys) VALUES (?, ?, ?, ?)
-                """,
-                (
-                    id.bytes,
-                    value.auth_key.value.to_bytes(32),
-                    value.contents,
-                    pickle.dumps(value.release_keys),
-                ),
-            )
+            # see `insert_user`.
+            if should_already_exist:
+                self._cursor.execute(
+                    """
+                    UPDATE items SET auth_key = ?2, contents = ?3, release_keys = ?4
+                    WHERE id = ?1 RETURNING id
+                    """,
+                    values,
+                )
+            else:
+                self._cursor.execute(
+                    """
+                    INSERT INTO items (id, auth_key, contents, release_keys) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (id) DO NOTHING RETURNING id
+                    """,
+                    values,
+                )
+            if not self._cursor.fetchall():
+                self._conn.rollback()
+                if should_already_exist:
+                    raise Exception(f"item {id} doesn't exist")
+                else:
+                    raise Exception(f"item {id} already exists")
+
             self._conn.commit()
     
     # Returns information stored about a user. If this function panics you can
@@ -181,7 +267,9 @@ class Database:
         with self._lock:
             self._cursor.execute(
                 """
-                SELECT auth_key, private_info, public_key, messages FROM users WHERE email = ?
+                SELECT users.auth_key, users.private_info, users.public_key, users.messages, user_descriptions.description
+                FROM users JOIN user_descriptions ON users.email = user_descriptions.email
+                WHERE users.email = ?
                 """,
                 (email.string,),
             )
@@ -189,22 +277,76 @@ class Database:
             if value is None:
                 raise Exception(f"user {email} doesn't exist")
 
-            self._cursor.execute(
-                """
-                SELECT description FROM user_descriptions WHERE email = ?
-                """,
-                (email.string,),
-            )
-            description_value = self._cursor.fetchone()
-
             return User(
                 auth_key=Key(int.from_bytes(value["auth_key"])),
                 private_info=value["private_info"],
                 public_key=Key(int.from_bytes(value["public_key"])),
                 messages=pickle.loads(value["messages"]),
-                description=description_value["description"],
+                description=value["description"],
             )
     
+    # Adds a message to the end of a user's messages. If this function panics
+    # you can guess that the user doesn't exist.
+    def add_message(self, email: Email, message: bytes):
+        with self._lock:
+            self._cursor.execute(
+                """
+                SELECT messages FROM users WHERE email = ?
+                """,
+                (email.string,),
+            )
+            value = self._cursor.fetchone()
+            if value is None:
+                raise Exception(f"user {email} doesn't exist")
+
+            messages = pickle.loads(value["messages"])
+            messages.append(message)
+            self._cursor.execute(
+                """
+                UPDATE users SET messages = ? WHERE email = ?
+                """,
+                (pickle.dumps(messages), email.string),
+            )
+            self._conn.commit()
+
+    # Replaces a user's private info and messages, leaving the rest of the user
+    # as it is. Unlike `get_user` followed by `insert_user` this is a single
+    # statement, so nothing that changed in between is written back from an old
+    # copy. If this function panics you can guess that the user doesn't exist.
+    def update_user_data(self, email: Email, private_info: bytes, messages: list[bytes]):
+        with self._lock:
+            self._cursor.execute(
+                """
+                UPDATE users SET private_info = ?, messages = ? WHERE email = ? RETURNING email
+                """,
+                (private_info, pickle.dumps(messages), email.string),
+            )
+            if not self._cursor.fetchall():
+                self._conn.rollback()
+                raise Exception(f"user {email} doesn't exist")
+
+            self._conn.commit()
+
+    # Returns the public information about all users.
+    def get_user_directory(self) -> list[PublicUserInfo]:
+        with self._lock:
+            self._cursor.execute(
+                """
+                SELECT users.email, users.public_key, user_descriptions.description
+                FROM users JOIN user_descriptions ON users.email = user_descriptions.email
+                ORDER BY users.email
+                """
+            )
+
+            return [
+                PublicUserInfo(
+                    email=Email(value["email"]),
+                    description=value["description"],
+                    public_key=Key(int.from_bytes(value["public_key"])),
+                )
+                for value in self._cursor.fetchall()
+            ]
+
     # Returns information stored about an item. If this function panics, the
     # item doesn't exist. The result of this function contains the actual data
     # of the item, which may be megabytes long. To exclude the actual item data,
@@ -248,6 +390,165 @@ class Database:
                 release_keys=pickle.loads(value["release_keys"]),
             )
 
+    # Returns the size in bytes of an item's contents. If this function panics,
+    # the item doesn't exist.
+    def get_item_contents_size(self, id: Uuid) -> int:
+        with self._lock:
+            return self._get_blob_size("items", "contents", "id", id.bytes, f"item {id}")
+
+    # Returns `length` bytes of an item's contents starting at `offset`, without
+    # reading the rest of the contents, and the size of the whole contents.
+    # Panics with `OutOfRangeError` if the range isn't inside the contents, or
+    # with another exception if the item doesn't exist.
+    def read_item_contents(self, id: Uuid, offset: int, length: int) -> tuple[bytes, int]:
+        with self._lock:
+            return self._read_blob("items", "contents", "id", id.bytes, f"item {id}", offset, length)
+
+    # Overwrites part of an item's contents starting at `offset` in place. This
+    # can't change the size of the contents, see `append_item_contents`. Panics
+    # like `read_item_contents`.
+    def write_item_contents(self, id: Uuid, offset: int, data: bytes):
+        with self._lock:
+            self._write_blob("items", "contents", "id", id.bytes, f"item {id}", offset, data)
+
+    # Adds `data` to the end of an item's contents. SQLite can't grow a blob in
+    # place so unlike `write_item_contents`, this rewrites the contents. If this
+    # function panics, the item doesn't exist.
+    def append_item_contents(self, id: Uuid, data: bytes):
+        with self._lock:
+            self._cursor.execute(
+                """
+                UPDATE items SET contents = CAST(contents || ? AS BLOB) WHERE id = ?
+                """,
+                (data, id.bytes),
+            )
+            if self._cursor.rowcount == 0:
+                self._conn.rollback()
+                raise Exception(f"item {id} doesn't exist")
+            self._conn.commit()
+
+    # Returns the size in bytes of a user's private info. If this function
+    # panics, the user doesn't exist.
+    def get_private_info_size(self, email: Email) -> int:
+        with self._lock:
+            return self._get_blob_size("users", "private_info", "email", email.string, f"user {email}")
+
+    # Like `read_item_contents` but for a user's private info.
+    def read_private_info(self, email: Email, offset: int, length: int) -> tuple[bytes, int]:
+        with self._lock:
+            return self._read_blob("users", "private_info", "email", email.string, f"user {email}", offset, length)
+
+    # Like `write_item_contents` but for a user's private info.
+    def write_private_info(self, email: Email, offset: int, data: bytes):
+        with self._lock:
+            self._write_blob("users", "private_info", "email", email.string, f"user {email}", offset, data)
+
+    # Copies the database into `target_dir` while its being used. The copy is
+    # the database as it was when the function was called. This doesn't use
+    # `_lock`, and the copy is made `pages_per_step` pages at a time with a
+    # `step_delay` seconds sleep between steps, so other queries are only
+    # slowed down a little. `progress` is called after every step with the
+    # amount of copied pages and the total amount of pages.
+    def backup(
+        self,
+        target_dir: str,
+        pages_per_step: int = BACKUP_PAGES_PER_STEP,
+        step_delay: float = 0.01,
+        progress: Callable[[int, int], None] | None = None,
+    ):
+        target_path = f"{target_dir}/.sqlite"
+        # the copy only gets its real name once its complete.
+        partial_path = f"{target_path}.partial"
+
+        source = sqlite3.connect(f"{self._data_dir}/.sqlite")
+        target = sqlite3.connect(partial_path)
+        try:
+            # the read transaction keeps the source on a single snapshot.
+            # Otherwise every write made while copying would restart the copy.
+            source.execute("BEGIN")
+            source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+
+            def on_step(status: int, remaining: int, total: int):
+                if progress is not None:
+                    progress(total - remaining, total)
+                # `sleep` of `Connection.backup` is only used when the database
+                # is locked, so the delay between steps is made here.
+                if remaining > 0 and step_delay > 0:
+                    sleep(step_delay)
+
+            source.backup(target, pages=pages_per_step, progress=on_step)
+        except Exception:
+            # an unfinished copy is useless, and shouldn't be left next to
+            # real backups.
+            target.close()
+            os.remove(partial_path)
+            raise
+        finally:
+            source.close()
+            target.close()
+
+        os.replace(partial_path, target_path)
+
+    # Returns the size of the database file and how much of it is unused.
+    def get_storage_stats(self) -> StorageStats:
+        with self._lock:
+            page_size = self._cursor.execute("PRAGMA page_size").fetchone()[0]
+            page_count = self._cursor.execute("PRAGMA page_count").fetchone()[0]
+            free_page_count = self._cursor.execute("PRAGMA freelist_count").fetchone()[0]
+
+        sqlite_path = f"{self._data_dir}/.sqlite"
+        file_size = 0
+        for path in (sqlite_path, f"{sqlite_path}-wal"):
+            if os.path.exists(path):
+                file_size += os.path.getsize(path)
+
+        return StorageStats(
+            file_size=file_size,
+            page_size=page_size,
+            page_count=page_count,
+            free_page_count=free_page_count,
+        )
+
+    # Returns the amount of unused pages, see `StorageStats::free_page_count`.
+    # This is cheaper than `get_storage_stats`.
+    def get_free_page_count(self) -> int:
+        with self._lock:
+            return self._cursor.execute("PRAGMA freelist_count").fetchone()[0]
+
+    # Gives up to `max_pages` unused pages back to the file system, making the
+    # file smaller. Returns how many pages were given back. Call this with a
+    # small `max_pages` to avoid holding the database for long.
+    def incremental_vacuum(self, max_pages: int) -> int:
+        with self._lock:
+            before = self._cursor.execute("PRAGMA freelist_count").fetchone()[0]
+            # `execute` only runs a single step of the pragma, which frees a
+            # single page.
+            self._conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)});")
+            after = self._cursor.execute("PRAGMA freelist_count").fetchone()[0]
+
+            return before - after
+
+    # Moves the changes in the write-ahead log into the database file and
+    # empties the log. Pages given back by `incremental_vacuum` only leave the
+    # file system once this happens.
+    def checkpoint(self):
+        with self._lock:
+            self._cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+    # Lets SQLite update the statistics it uses to plan queries if it thinks
+    # they are outdated. This is cheap and should be called once in a while.
+    def optimize(self):
+        with self._lock:
+            self._cursor.execute("PRAGMA optimize").fetchall()
+            self._conn.commit()
+
+    # Recalculates all the statistics SQLite uses to plan queries. This reads
+    # the whole database so it should be called rarely.
+    def analyze(self):
+        with self._lock:
+            self._cursor.execute("ANALYZE")
+            self._conn.commit()
+
     # Removes the info about a user from the database. This function does not
     # panic if the user doesn't exist.
     def remove_user(self, email: Email):
@@ -271,3 +572,51 @@ class Database:
                 (id.bytes,),
             )
             self._conn.commit()
+
+    # The following functions should only be called while holding `_lock`.
+    # `name` is used for error messages.
+
+    def _get_blob_size(self, table: str, column: str, key_column: str, key, name: str) -> int:
+        self._cursor.execute(
+            f"""
+            SELECT length({column}) AS size FROM {table} WHERE {key_column} = ?
+            """,
+            (key,),
+        )
+        value = self._cursor.fetchone()
+        if value is None:
+            raise Exception(f"{name} doesn't exist")
+
+        return value["size"]
+
+    def _read_blob(self, table: str, column: str, key_column: str, key, name: str, offset: int, length: int) -> tuple[bytes, int]:
+        rowid = self._get_rowid(table, key_column, key, name)
+        with self._conn.blobopen(table, column, rowid, readonly=True) as blob:
+            _check_range(name, offset, length, len(blob))
+            blob.seek(offset)
+            return blob.read(length), len(blob)
+
+    def _write_blob(self, table: str, column: str, key_column: str, key, name: str, offset: int, data: bytes):
+        rowid = self._get_rowid(table, key_column, key, name)
+        with self._conn.blobopen(table, column, rowid) as blob:
+            _check_range(name, offset, len(data), len(blob))
+            blob.seek(offset)
+            blob.write(data)
+        self._conn.commit()
+
+    def _get_rowid(self, table: str, key_column: str, key, name: str) -> int:
+        self._cursor.execute(
+            f"""
+            SELECT rowid FROM {table} WHERE {key_column} = ?
+            """,
+            (key,),
+        )
+        value = self._cursor.fetchone()
+        if value is None:
+            raise Exception(f"{name} doesn't exist")
+
+        return value["rowid"]
+
+def _check_range(name: str, offset: int, length: int, size: int):
+    if offset < 0 or length < 0 or offset + length > size:
+        raise OutOfRangeError(f"bytes {offset}..{offset + length} are outside of {name} which has {size}", size)
@@ -24,9 +24,15 @@ class Key:
         key_bytes = self.value.to_bytes(32)
         hash_bytes = hashlib.scrypt(
             password=key_bytes,
-            salt="yarden-cohen",
+            salt=b"yarden-cohen",
             # `n` is internal memory size. (python has no docs...).
             n=2**15,
+            # block size and parallelization, python requires them.
+            r=8,
+            p=1,
+            # the default limit is exactly what `n` and `r` need, without the
+            # overhead.
+            maxmem=64 * 1024 * 1024,
             # output byte count. (python has no docs...).
             dklen=32,
         )
@@ -0,0 +1,99 @@
+from threading import Event, Thread
+from time import time
+from typing import Callable
+
+from .database import Database
+
+# Seconds between checks for something to do.
+CHECK_INTERVAL = 0.1
+# How many unused pages are given back to the file system at a time.
+VACUUM_PAGES_PER_STEP = 64
+# Seconds between looking for unused pages once there were none. Large
+# removals are rare, so they can wait a bit before their pages are given back.
+FREE_PAGE_CHECK_INTERVAL = 60.0
+# Seconds between calls to `Database::optimize`.
+OPTIMIZE_INTERVAL = 60.0 * 60.0
+# Seconds between calls to `Database::analyze`.
+ANALYZE_INTERVAL = 24.0 * 60.0 * 60.0
+# Seconds between printing the size of the database.
+REPORT_INTERVAL = 10.0 * 60.0
+
+class DatabaseMaintenance:
+    """
+    Keeps the database file compact on a background thread.
+
+    Removing large items and users leaves unused pages in the file. While the
+    server is idle, those pages are given back to the file system a few at a
+    time so that requests are never stuck behind a long vacuum. Once in a while
+    the query planner statistics are updated and the size of the database is
+    printed.
+    """
+
+    _db: Database
+    _is_idle: Callable[[], bool]
+    _stop: Event
+    _thread: Thread | None
+
+    def __init__(self, db: Database, is_idle: Callable[[], bool]):
+        self._db = db
+        # called from the background thread to check that the server isn't
+        # busy with requests.
+        self._is_idle = is_idle
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        now = time()
+        next_optimize = now + OPTIMIZE_INTERVAL
+        next_analyze = now + ANALYZE_INTERVAL
+        next_report = now
+        next_free_page_check = now
+
+        while not self._stop.wait(CHECK_INTERVAL):
+            now = time()
+            if now >= next_report:
+                self._report()
+                next_report = now + REPORT_INTERVAL
+
+            if not self._is_idle():
+                continue
+
+            try:
+                if now >= next_analyze:
+                    self._db.analyze()
+                    next_analyze = now + ANALYZE_INTERVAL
+                    next_optimize = now + OPTIMIZE_INTERVAL
+                elif now >= next_optimize:
+                    self._db.optimize()
+                    next_optimize = now + OPTIMIZE_INTERVAL
+
+                if now >= next_free_page_check:
+                    free_page_count = self._db.get_free_page_count()
+                    if free_page_count == 0:
+                        next_free_page_check = now + FREE_PAGE_CHECK_INTERVAL
+                    elif self._db.incremental_vacuum(VACUUM_PAGES_PER_STEP) >= free_page_count:
+                        # the file only shrinks once the log is checkpointed.
+                        self._db.checkpoint()
+            except Exception as e:
+                print(f"maintenance: failed, {e}")
+
+    def _report(self):
+        try:
+            stats = self._db.get_storage_stats()
+        except Exception as e:
+            print(f"maintenance: failed, {e}")
+            return
+
+        print(
+            f"maintenance: database is {stats.file_size} bytes, "
+            f"{stats.free_page_count}/{stats.page_count} pages unused ({stats.fragmentation:.1%})"
+        )
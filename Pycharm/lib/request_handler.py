@@ -1,12 +1,391 @@
+from itertools import count
+from time import time
+from uuid import UUID as Uuid, uuid4
+
 from .socket_wrapper import ServerConnection
-from .request import Request
+from .database import Database, User, Item, ReleaseKey, OutOfRangeError
+from .email import Email
+from .key import Key
+from .subscriptions import SubscriptionHub
+from .trace import TraceRecorder
+from .request_response import (
+    Request,
+    Response,
+    SignupRequest,
+    SignupResponse,
+    LoginRequest,
+    LoginResponse,
+    FetchRequest,
+    FetchResponse,
+    PushRequest,
+    PushResponse,
+    SendRequest,
+    SendResponse,
+    ItemRequest,
+    ItemResponse,
+    CreateItemRequest,
+    CreateItemResponse,
+    EncryptItemRequest,
+    EncryptItemResponse,
+    ReleaseItemRequest,
+    ReleaseItemResponse,
+    ItemRangeRequest,
+    ItemRangeResponse,
+    WriteItemRangeRequest,
+    WriteItemRangeResponse,
+    AppendItemRequest,
+    AppendItemResponse,
+    PrivateInfoRangeRequest,
+    PrivateInfoRangeResponse,
+    WritePrivateInfoRangeRequest,
+    WritePrivateInfoRangeResponse,
+    SubscribeRequest,
+    SubscribeResponse,
+)
+
+# The largest message that can be sent using `SendRequest`.
+MAX_MESSAGE_SIZE = 64 * 1024
+# How many item keys each client remembers, see `Client::verified_item_keys`.
+MAX_VERIFIED_ITEM_KEYS = 64
+
+_next_client_id = count()
 
 class Client:
-    _conn: ClientConnection
+    conn: ServerConnection
+    # A number that is different for every client the server ever had, unlike
+    # `fd` which is reused.
+    id: int
+    # The file descriptor of the connection's socket. Its kept here because the
+    # socket forgets it once its closed.
+    fd: int
+    # `True` while a worker thread is handling a request of this client. The
+    # connection must not be touched by the main thread during that time.
+    is_busy: bool
+    # The user the client logged in as, or `None` before a successful login.
+    email: Email | None
+    # `True` if the client asked to be notified about new messages. Such a
+    # client is expected to stay quiet so it isn't disconnected for being idle.
+    # If it vanishes without closing the connection, TCP keepalive finds out
+    # (see `KEEPALIVE_IDLE`).
+    is_subscribed: bool
+    # The auth keys (see `ItemRequest::auth_key`) that were already checked on
+    # this connection, by item ID. Hashing an auth key takes much longer than
+    # the ranged item requests themselves, so those only hash it once.
+    verified_item_keys: dict[bytes, int]
 
     def __init__(self, conn: ServerConnection):
         self.conn = conn
+        self.id = next(_next_client_id)
+        self.fd = conn.fileno()
+        self.is_busy = False
+        self.email = None
+        self.is_subscribed = False
+        self.verified_item_keys = {}
+
+def handle_next_request(
+    client: Client,
+    db: Database,
+    subscriptions: SubscriptionHub,
+    recorder: TraceRecorder | None = None,
+):
+    """
+    Receives a single request from the client and sends the response.
+
+    Does nothing if the client didn't send a whole request yet. A client that
+    sends something that isn't a request is disconnected. If `recorder` isn't
+    `None`, the request is added to its trace.
+    """
+
+    # connections are only shut down here. The main thread closes them when it
+    # removes the client (see `ConnectionManager::remove`).
+    try:
+        request = client.conn.recv()
+    except Exception:
+        client.conn.shutdown()
+        return
+
+    if request is None:
+        return
+
+    received_time = time()
+    try:
+        response = _handle(client, db, subscriptions, request)
+    except Exception:
+        # the client can't tell what happened to the request, so its better to
+        # disconnect it than to leave it waiting for a response.
+        client.conn.shutdown()
+        return
+
+    try:
+        client.conn.send(response)
+    except OSError:
+        # the connection is marked as closed and will be reaped.
+        pass
+
+    if recorder is not None:
+        recorder.record(client.id, request, response, received_time, time() - received_time)
+
+def _handle(client: Client, db: Database, subscriptions: SubscriptionHub, request: Request) -> Response:
+    match request:
+        case SignupRequest():
+            return _signup(db, request)
+        case LoginRequest():
+            return _login(client, db, request)
+        case FetchRequest():
+            return _fetch(client, db)
+        case PushRequest():
+            return _push(client, db, request)
+        case SendRequest():
+            return _send(client, db, subscriptions, request)
+        case ItemRequest():
+            return _item(db, request)
+        case CreateItemRequest():
+            return _create_item(db, request)
+        case EncryptItemRequest():
+            return _encrypt_item(db, request)
+        case ReleaseItemRequest():
+            return _release_item(db, request)
+        case ItemRangeRequest():
+            return _item_range(client, db, request)
+        case WriteItemRangeRequest():
+            return _write_item_range(client, db, request)
+        case AppendItemRequest():
+            return _append_item(client, db, request)
+        case PrivateInfoRangeRequest():
+            return _private_info_range(client, db, request)
+        case WritePrivateInfoRangeRequest():
+            return _write_private_info_range(client, db, request)
+        case SubscribeRequest():
+            return _subscribe(client, subscriptions)
+
+def _signup(db: Database, request: SignupRequest) -> SignupResponse:
+    try:
+        email = Email(request.email)
+        if len(request.public_key) != 32:
+            raise Exception("a public key must be 32 bytes")
+        user = User(
+            auth_key=Key(request.auth_key).hash(),
+            private_info=bytes(),
+            public_key=Key(int.from_bytes(request.public_key)),
+            messages=[],
+            description="",
+        )
+    except Exception:
+        return SignupResponse(type="SignupResponse", is_succees=False, email_is_taken=False)
+
+    try:
+        db.insert_user(email, user, False)
+    except Exception:
+        return SignupResponse(type="SignupResponse", is_succees=False, email_is_taken=True)
+
+    return SignupResponse(type="SignupResponse", is_succees=True, email_is_taken=False)
+
+def _login(client: Client, db: Database, request: LoginRequest) -> LoginResponse:
+    try:
+        email = Email(request.email)
+        user = db.get_user(email)
+        password_is_correct = Key(request.auth_key).hash() == user.auth_key
+    except Exception:
+        return LoginResponse(type="LoginResponse", is_succees=False, password_is_correct=False)
+
+    if password_is_correct:
+        client.email = email
+
+    return LoginResponse(type="LoginResponse", is_succees=password_is_correct, password_is_correct=password_is_correct)
+
+def _fetch(client: Client, db: Database) -> FetchResponse:
+    user = db.get_user(client.email) if client.email is not None else None
+    directory = db.get_user_directory()
+
+    return FetchResponse(
+        type="FetchResponse",
+        private_info=user.private_info if user is not None else bytes(),
+        messages=user.messages if user is not None else [],
+        user_emails=[info.email.string for info in directory],
+        user_descriptions=[info.description for info in directory],
+        user_public_keys=[info.public_key.value.to_bytes(32) for info in directory],
+    )
+
+def _push(client: Client, db: Database, request: PushRequest) -> PushResponse:
+    if client.email is None:
+        return PushResponse(type="PushResponse", is_succees=False)
+
+    try:
+        db.update_user_data(client.email, request.private_info, request.messages)
+    except Exception:
+        return PushResponse(type="PushResponse", is_succees=False)
+
+    return PushResponse(type="PushResponse", is_succees=True)
+
+def _send(client: Client, db: Database, subscriptions: SubscriptionHub, request: SendRequest) -> SendResponse:
+    if client.email is None or len(request.content) > MAX_MESSAGE_SIZE:
+        return SendResponse(type="SendResponse", is_succees=False)
+
+    try:
+        target_email = Email(request.target_email)
+        db.add_message(target_email, request.content)
+    except Exception:
+        return SendResponse(type="SendResponse", is_succees=False)
+
+    subscriptions.notify(target_email)
+    return SendResponse(type="SendResponse", is_succees=True)
+
+def _item(db: Database, request: ItemRequest) -> ItemResponse:
+    try:
+        item = db.get_item(Uuid(bytes=request.id))
+    except Exception:
+        return ItemResponse(type="ItemResponse", is_success=False, wrong_key=False, contents=bytes(), release_key_contents=[])
+
+    if Key(request.auth_key).hash() != item.auth_key:
+        return ItemResponse(type="ItemResponse", is_success=False, wrong_key=True, contents=bytes(), release_key_contents=[])
+
+    return ItemResponse(
+        type="ItemResponse",
+        is_success=True,
+        wrong_key=False,
+        contents=item.contents,
+        release_key_contents=[release_key.info for release_key in item.release_keys],
+    )
+
+def _create_item(db: Database, request: CreateItemRequest) -> CreateItemResponse:
+    id = uuid4()
+    try:
+        db.insert_item(id, Item(auth_key=Key(request.auth_key).hash(), contents=request.contents, release_keys=[]), False)
+    except Exception:
+        return CreateItemResponse(type="CreateItemResponse", is_success=False, id=bytes())
+
+    return CreateItemResponse(type="CreateItemResponse", is_success=True, id=id.bytes)
+
+def _encrypt_item(db: Database, request: EncryptItemRequest) -> EncryptItemResponse:
+    try:
+        item = db.get_item_metadata(Uuid(bytes=request.id))
+    except Exception:
+        return EncryptItemResponse(type="EncryptItemResponse", is_success=False, wrong_key=False)
+
+    if Key(request.auth_key).hash() != item.auth_key:
+        return EncryptItemResponse(type="EncryptItemResponse", is_success=False, wrong_key=True)
+
+    # the protocol doesn't specify which encryption `EncryptItemRequest` uses
+    # yet, so the contents are left as they are and the client is told that it
+    # failed.
+    return EncryptItemResponse(type="EncryptItemResponse", is_success=False, wrong_key=False)
+
+def _release_item(db: Database, request: ReleaseItemRequest) -> ReleaseItemResponse:
+    try:
+        id = Uuid(bytes=request.id)
+        item = db.get_item(id)
+        if Key(request.auth_key).hash() != item.auth_key:
+            return ReleaseItemResponse(type="ReleaseItemResponse", is_success=False)
+
+        item.release_keys.append(ReleaseKey(info=request.info, expires=request.expires))
+        db.insert_item(id, item, True)
+    except Exception:
+        return ReleaseItemResponse(type="ReleaseItemResponse", is_success=False)
+
+    return ReleaseItemResponse(type="ReleaseItemResponse", is_success=True)
+
+# Returns `True` if `auth_key` is the key of the item. Panics if the item
+# doesn't exist, unless the key was already checked on this connection, in
+# which case the database call that follows fails instead.
+def _check_item_key(client: Client, db: Database, id: Uuid, auth_key: int) -> bool:
+    if client.verified_item_keys.get(id.bytes) == auth_key:
+        return True
+
+    # the metadata doesn't include the contents which may be very large.
+    item = db.get_item_metadata(id)
+    if Key(auth_key).hash() != item.auth_key:
+        return False
+
+    if len(client.verified_item_keys) >= MAX_VERIFIED_ITEM_KEYS:
+        # forgets the oldest key.
+        del client.verified_item_keys[next(iter(client.verified_item_keys))]
+    client.verified_item_keys[id.bytes] = auth_key
+    return True
+
+def _item_range(client: Client, db: Database, request: ItemRangeRequest) -> ItemRangeResponse:
+    try:
+        id = Uuid(bytes=request.id)
+        is_key_correct = _check_item_key(client, db, id, request.auth_key)
+    except Exception:
+        return ItemRangeResponse(type="ItemRangeResponse", is_success=False, wrong_key=False, out_of_range=False, contents=bytes(), size=0)
+
+    if not is_key_correct:
+        return ItemRangeResponse(type="ItemRangeResponse", is_success=False, wrong_key=True, out_of_range=False, contents=bytes(), size=0)
+
+    try:
+        contents, size = db.read_item_contents(id, request.offset, request.length)
+    except OutOfRangeError as e:
+        return ItemRangeResponse(type="ItemRangeResponse", is_success=False, wrong_key=False, out_of_range=True, contents=bytes(), size=e.size)
+    except Exception:
+        return ItemRangeResponse(type="ItemRangeResponse", is_success=False, wrong_key=False, out_of_range=False, contents=bytes(), size=0)
+
+    return ItemRangeResponse(type="ItemRangeResponse", is_success=True, wrong_key=False, out_of_range=False, contents=contents, size=size)
+
+def _write_item_range(client: Client, db: Database, request: WriteItemRangeRequest) -> WriteItemRangeResponse:
+    try:
+        id = Uuid(bytes=request.id)
+        is_key_correct = _check_item_key(client, db, id, request.auth_key)
+    except Exception:
+        return WriteItemRangeResponse(type="WriteItemRangeResponse", is_success=False, wrong_key=False, out_of_range=False)
+
+    if not is_key_correct:
+        return WriteItemRangeResponse(type="WriteItemRangeResponse", is_success=False, wrong_key=True, out_of_range=False)
+
+    try:
+        db.write_item_contents(id, request.offset, request.data)
+    except IndexError:
+        return WriteItemRangeResponse(type="WriteItemRangeResponse", is_success=False, wrong_key=False, out_of_range=True)
+    except Exception:
+        return WriteItemRangeResponse(type="WriteItemRangeResponse", is_success=False, wrong_key=False, out_of_range=False)
+
+    return WriteItemRangeResponse(type="WriteItemRangeResponse", is_success=True, wrong_key=False, out_of_range=False)
+
+def _append_item(client: Client, db: Database, request: AppendItemRequest) -> AppendItemResponse:
+    try:
+        id = Uuid(bytes=request.id)
+        is_key_correct = _check_item_key(client, db, id, request.auth_key)
+    except Exception:
+        return AppendItemResponse(type="AppendItemResponse", is_success=False, wrong_key=False)
+
+    if not is_key_correct:
+        return AppendItemResponse(type="AppendItemResponse", is_success=False, wrong_key=True)
+
+    try:
+        db.append_item_contents(id, request.data)
+    except Exception:
+        return AppendItemResponse(type="AppendItemResponse", is_success=False, wrong_key=False)
+
+    return AppendItemResponse(type="AppendItemResponse", is_success=True, wrong_key=False)
+
+def _private_info_range(client: Client, db: Database, request: PrivateInfoRangeRequest) -> PrivateInfoRangeResponse:
+    if client.email is None:
+        return PrivateInfoRangeResponse(type="PrivateInfoRangeResponse", is_success=False, out_of_range=False, private_info=bytes(), size=0)
+
+    try:
+        private_info, size = db.read_private_info(client.email, request.offset, request.length)
+    except OutOfRangeError as e:
+        return PrivateInfoRangeResponse(type="PrivateInfoRangeResponse", is_success=False, out_of_range=True, private_info=bytes(), size=e.size)
+    except Exception:
+        return PrivateInfoRangeResponse(type="PrivateInfoRangeResponse", is_success=False, out_of_range=False, private_info=bytes(), size=0)
+
+    return PrivateInfoRangeResponse(type="PrivateInfoRangeResponse", is_success=True, out_of_range=False, private_info=private_info, size=size)
+
+def _write_private_info_range(client: Client, db: Database, request: WritePrivateInfoRangeRequest) -> WritePrivateInfoRangeResponse:
+    if client.email is None:
+        return WritePrivateInfoRangeResponse(type="WritePrivateInfoRangeResponse", is_success=False, out_of_range=False)
+
+    try:
+        db.write_private_info(client.email, request.offset, request.data)
+    except IndexError:
+        return WritePrivateInfoRangeResponse(type="WritePrivateInfoRangeResponse", is_success=False, out_of_range=True)
+    except Exception:
+        return WritePrivateInfoRangeResponse(type="WritePrivateInfoRangeResponse", is_success=False, out_of_range=False)
+
+    return WritePrivateInfoRangeResponse(type="WritePrivateInfoRangeResponse", is_success=True, out_of_range=False)
+
+def _subscribe(client: Client, subscriptions: SubscriptionHub) -> SubscribeResponse:
+    if client.email is None:
+        return SubscribeResponse(type="SubscribeResponse", is_success=False)
 
-def handle_next_request(client: Client):
-    # TODO: handle the request.
-    pass
+    subscriptions.subscribe(client, client.email)
+    return SubscribeResponse(type="SubscribeResponse", is_success=True)
@@ -1,5 +1,7 @@
-from dataclasses import dataclass
-from typing import Literal
+import json
+import base64
+from dataclasses import dataclass, fields
+from typing import Literal, get_args, get_origin, get_type_hints
 from datetime import datetime
 
 # A request from a client to create a new user.
@@ -12,6 +14,9 @@ class SignupRequest:
     # will then be hashed again by the server then stored on the database to use
     # for comparison on each attempt to login.
     auth_key: int
+    # The user's public key (32 bytes) that other users encrypt the messages
+    # they send to the user with. See `FetchResponse::user_public_keys`.
+    public_key: bytes
 
 # The server's response to `SignupRequest`.
 @dataclass
@@ -204,5 +209,194 @@ class ReleaseItemResponse:
     # Is it succesful.
     is_success: bool
 
-Request = SignupRequest | LoginRequest | FetchRequest | PushRequest | SendRequest | ItemRequest | CreateItemRequest | EncryptItemRequest | ReleaseItemRequest
-Response = SignupResponse | LoginResponse | FetchResponse | PushResponse | SendResponse | ItemResponse | CreateItemResponse | EncryptItemResponse | ReleaseItemResponse
+# A request to get part of an item's contents, without the rest of the contents
+# or the release keys. Useful for items that are too large to get at once.
+@dataclass
+class ItemRangeRequest:
+    type: Literal["ItemRangeRequest"]
+    # The item ID.
+    id: bytes
+    # See `ItemRequest::auth_key`.
+    auth_key: int
+    # The index of the first byte to get.
+    offset: int
+    # How many bytes to get.
+    length: int
+
+# The server's response to `ItemRangeRequest`.
+@dataclass
+class ItemRangeResponse:
+    type: Literal["ItemRangeResponse"]
+    # Is it succesful.
+    is_success: bool
+    # Did the request fail because authentication fail?
+    wrong_key: bool
+    # Did the request fail because the range isn't inside the contents?
+    out_of_range: bool
+    # The requested part of the contents.
+    contents: bytes
+    # The size of the whole contents in bytes, so the client knows what ranges
+    # it can request. This is set even if `out_of_range` is true.
+    size: int
+
+# A request to overwrite part of an item's contents. This can't change the size
+# of the contents, see `AppendItemRequest`.
+@dataclass
+class WriteItemRangeRequest:
+    type: Literal["WriteItemRangeRequest"]
+    # The item ID.
+    id: bytes
+    # See `ItemRequest::auth_key`.
+    auth_key: int
+    # The index of the first byte to overwrite.
+    offset: int
+    # The bytes that replace the bytes starting at `offset`.
+    data: bytes
+
+# The server's response to `WriteItemRangeRequest`.
+@dataclass
+class WriteItemRangeResponse:
+    type: Literal["WriteItemRangeResponse"]
+    # Is it succesful.
+    is_success: bool
+    # Did the request fail because authentication fail?
+    wrong_key: bool
+    # Did the request fail because the range isn't inside the contents?
+    out_of_range: bool
+
+# A request to add bytes to the end of an item's contents.
+@dataclass
+class AppendItemRequest:
+    type: Literal["AppendItemRequest"]
+    # The item ID.
+    id: bytes
+    # See `ItemRequest::auth_key`.
+    auth_key: int
+    # The bytes to add.
+    data: bytes
+
+# The server's response to `AppendItemRequest`.
+@dataclass
+class AppendItemResponse:
+    type: Literal["AppendItemResponse"]
+    # Is it succesful.
+    is_success: bool
+    # Did the request fail because authentication fail?
+    wrong_key: bool
+
+# A request to get part of the logged in user's private info. See
+# `FetchResponse::private_info`.
+@dataclass
+class PrivateInfoRangeRequest:
+    type: Literal["PrivateInfoRangeRequest"]
+    # The index of the first byte to get.
+    offset: int
+    # How many bytes to get.
+    length: int
+
+# The server's response to `PrivateInfoRangeRequest`.
+@dataclass
+class PrivateInfoRangeResponse:
+    type: Literal["PrivateInfoRangeResponse"]
+    # Is it succesful. Fails if the client isn't logged in.
+    is_success: bool
+    # Did the request fail because the range isn't inside the private info?
+    out_of_range: bool
+    # The requested part of the private info.
+    private_info: bytes
+    # The size of the whole private info in bytes.
+    size: int
+
+# A request to overwrite part of the logged in user's private info without
+# sending all of it like `PushRequest` does. This can't change the size of the
+# private info.
+@dataclass
+class WritePrivateInfoRangeRequest:
+    type: Literal["WritePrivateInfoRangeRequest"]
+    # The index of the first byte to overwrite.
+    offset: int
+    # The bytes that replace the bytes starting at `offset`.
+    data: bytes
+
+# The server's response to `WritePrivateInfoRangeRequest`.
+@dataclass
+class WritePrivateInfoRangeResponse:
+    type: Literal["WritePrivateInfoRangeResponse"]
+    # Is it succesful. Fails if the client isn't logged in.
+    is_success: bool
+    # Did the request fail because the range isn't inside the private info?
+    out_of_range: bool
+
+# A request from a logged in client to be told when messages are sent to their
+# user, instead of polling with `FetchRequest`. After a successful response the
+# server sends `NewMessagesNotification`s on the same connection, so the
+# connection shouldn't be used for other requests.
+@dataclass
+class SubscribeRequest:
+    type: Literal["SubscribeRequest"]
+
+# The server's response to `SubscribeRequest`.
+@dataclass
+class SubscribeResponse:
+    type: Literal["SubscribeResponse"]
+    # Is it succesful. Fails if the client isn't logged in.
+    is_success: bool
+
+# Sent by the server to subscribed connections (see `SubscribeRequest`) when
+# messages are sent to the user. Messages that arrive close together are
+# reported by a single notification. The messages themselves are read using
+# `FetchRequest`.
+@dataclass
+class NewMessagesNotification:
+    type: Literal["NewMessagesNotification"]
+    # How many messages were sent to the user since the last notification.
+    count: int
+
+Request = SignupRequest | LoginRequest | FetchRequest | PushRequest | SendRequest | ItemRequest | CreateItemRequest | EncryptItemRequest | ReleaseItemRequest | ItemRangeRequest | WriteItemRangeRequest | AppendItemRequest | PrivateInfoRangeRequest | WritePrivateInfoRangeRequest | SubscribeRequest
+Response = SignupResponse | LoginResponse | FetchResponse | PushResponse | SendResponse | ItemResponse | CreateItemResponse | EncryptItemResponse | ReleaseItemResponse | ItemRangeResponse | WriteItemRangeResponse | AppendItemResponse | PrivateInfoRangeResponse | WritePrivateInfoRangeResponse | SubscribeResponse | NewMessagesNotification
+
+_MESSAGE_TYPES = {t.__name__: t for t in get_args(Request) + get_args(Response)}
+
+def serialize(message: Request | Response) -> bytes:
+    """
+    Converts a request or a response to the bytes sent over the socket.
+
+    Messages are sent as JSON where `bytes` are base64 encoded and `datetime`s
+    are in ISO format.
+    """
+
+    value = {field.name: _encode(getattr(message, field.name)) for field in fields(message)}
+    return json.dumps(value).encode()
+
+def deserialize(data: bytes) -> Request | Response:
+    """
+    The opposite of `serialize`. Raises an exception if the data isn't a valid
+    message.
+    """
+
+    value = json.loads(data)
+    message_type = _MESSAGE_TYPES[value["type"]]
+    hints = get_type_hints(message_type)
+    return message_type(**{
+        field.name: _decode(value[field.name], hints[field.name])
+        for field in fields(message_type)
+    })
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    return value
+
+def _decode(value, hint):
+    if hint is bytes:
+        return base64.b64decode(value)
+    if hint is datetime:
+        return datetime.fromisoformat(value)
+    if get_origin(hint) is list:
+        (item_hint,) = get_args(hint)
+        return [_decode(item, item_hint) for item in value]
+    return value
@@ -1,13 +1,29 @@
-import json
-from time import time, sleep
-from socket import socket
+import socket as socket_module
+from collections import deque
+from time import time
+from socket import socket, create_connection, AF_INET, AF_INET6, IPPROTO_TCP, TCP_NODELAY, SOL_SOCKET, SO_KEEPALIVE, SHUT_RDWR
 from select import select
 
-from .request_response import Request, Response
+from .request_response import Request, Response, serialize, deserialize
 
 SERVER_PORT = 2048
 SERVER_IP = "INSERT IP HERE"
 
+# The maximum amount of received bytes a single connection may hold before
+# they are handled. A peer that sends more than this is disconnected.
+MAX_BUFFERED_SIZE = 16 * 1024 * 1024
+# Seconds to wait for the peer to make room for the rest of a message before
+# giving up on the connection.
+SEND_TIMEOUT = 30.0
+# TCP keepalive settings of the server's connections: after `KEEPALIVE_IDLE`
+# quiet seconds the peer is probed every `KEEPALIVE_INTERVAL` seconds, and the
+# connection is closed after `KEEPALIVE_COUNT` unanswered probes. This finds
+# peers that vanished without closing the connection, like subscribed clients
+# (see `SubscribeRequest`) that lost their network.
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 6
+
 class RawConnection:
     """
     A raw peer to peer socket.
@@ -17,24 +33,107 @@ class RawConnection:
 
     _socket: socket
     _recv_buf: bytearray
-    _recv_list: list[bytes]
+    _recv_list: deque[bytes]
+    _buffered_size: int
+    _max_buffered_size: int
+    _is_closed: bool
+    _last_activity: float
 
-    def __init__(self, s: socket):
+    def __init__(self, s: socket, max_buffered_size: int = MAX_BUFFERED_SIZE):
         self._socket = s
         self._socket.setblocking(False)
+        if s.family in (AF_INET, AF_INET6):
+            # messages are small and answered right away, so waiting to fill a
+            # whole packet only adds latency.
+            self._socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
         self._recv_buf = bytearray()
-        self._recv_list = []
+        self._recv_list = deque()
+        self._buffered_size = 0
+        self._max_buffered_size = max_buffered_size
+        self._is_closed = False
+        self._last_activity = time()
+
+    def fileno(self) -> int:
+        """
+        The file descriptor of the socket. This makes the connection usable
+        with `select`.
+        """
+
+        return self._socket.fileno()
+
+    @property
+    def is_closed(self) -> bool:
+        """
+        `True` once the peer has disconnected, the socket has errored, or the
+        peer has sent more than the connection is allowed to buffer. A closed
+        connection never receives anything again.
+        """
+
+        return self._is_closed
+
+    @property
+    def last_activity(self) -> float:
+        """
+        The time (see `time.time`) when something was last sent or received.
+        """
+
+        return self._last_activity
+
+    @property
+    def buffered_size(self) -> int:
+        """
+        The amount of received bytes that are stored by the connection and
+        weren't returned by `recv_raw` yet.
+        """
+
+        return self._buffered_size
 
     def has_input(self) -> bool:
-        r_list, _, _ = select([self._socket], [], [], 0)[0]
+        if self._is_closed:
+            return False
+
+        r_list, _, _ = select([self._socket], [], [], 0)
         if r_list:
             return True
         else:
             return False
 
-    def recv_raw(self) -> bytes | None:
-        if self.has_input():
-            self._recv_buf.extend(self._socket.recv(65536))
+    def has_message(self) -> bool:
+        """
+        Returns `True` if a whole message was already received and `recv_raw`
+        would return it.
+        """
+
+        return len(self._recv_list) > 0
+
+    def fill_buffer(self):
+        """
+        Receives whatever is waiting on the socket without blocking.
+
+        If the peer disconnected or the socket errored, the connection is marked
+        as closed. The same happens if the peer sends more than
+        `max_buffered_size` bytes that weren't taken by `recv_raw` yet.
+        """
+
+        if not self.has_input():
+            return
+
+        try:
+            chunk = self._socket.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._mark_closed()
+            return
+
+        if not chunk:
+            # an empty read means the peer closed its side of the socket.
+            self._mark_closed()
+            return
+
+        self._last_activity = time()
+        self._recv_buf.extend(chunk)
+        self._buffered_size += len(chunk)
 
         while True:
             if len(self._recv_buf) < 4:
@@ -42,23 +141,69 @@ class RawConnection:
                 break
 
             length = int.from_bytes(self._recv_buf[:4])
+            if length > self._max_buffered_size:
+                # there is no point in waiting for a message we won't store.
+                self._mark_closed()
+                return
+
             if len(self._recv_buf) < 4 + length:
                 # we should wait until the whole message is sent.
                 break
 
-            self._recv_buf = self._recv_buf[4:]
+            self._recv_list.append(bytes(self._recv_buf[4:4 + length]))
+            del self._recv_buf[:4 + length]
+            self._buffered_size -= 4
 
-            self._recv_list.append(self._recv_buf[:length])
-            self._recv_buf = self._recv_buf[length:]
+        if self._buffered_size > self._max_buffered_size:
+            self._mark_closed()
+
+    def wait_for_message(self, timeout: float) -> bool:
+        """
+        Blocks until a whole message was received, the connection is closed, or
+        `timeout` seconds have passed. Returns `True` if there is a message.
+
+        This sleeps inside `select` so it doesn't use the CPU while waiting.
+        """
+
+        deadline = time() + timeout
+        while True:
+            self.fill_buffer()
+            if self.has_message():
+                return True
+            if self._is_closed:
+                return False
+
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+
+            select([self._socket], [], [], remaining)
+
+    def recv_raw(self, timeout: float = 0) -> bytes | None:
+        """
+        Returns the next message, or `None` if no whole message arrived within
+        `timeout` seconds. The default of 0 never blocks.
+        """
+
+        self.wait_for_message(timeout)
 
         if len(self._recv_list) == 0:
             return None
         
-        return self._recv_list.pop(0)
+        message = self._recv_list.popleft()
+        self._buffered_size -= len(message)
+        return message
 
     def send_raw(self, message: bytes):
-        self._socket.send(len(message).to_bytes(4))
-        self._socket.send(message)
+        try:
+            # a single send so the size and the message don't leave in
+            # separate packets.
+            self._send_all(len(message).to_bytes(4) + message)
+        except OSError:
+            self._mark_closed()
+            raise
+
+        self._last_activity = time()
 
     def close(self):
         """
@@ -67,31 +212,74 @@ class RawConnection:
         Do not use the socket after calling this function.
         """
 
+        self._mark_closed()
         self._socket.close()
 
+    def shutdown(self):
+        """
+        Ends the connection like `close`, but keeps the socket's file
+        descriptor until `close` is called. Use this when another thread owns
+        the connection, so the file descriptor can't be given to a new socket
+        while the owner still knows the connection by it.
+        """
+
+        self._mark_closed()
+        try:
+            self._socket.shutdown(SHUT_RDWR)
+        except OSError:
+            # the peer may have disconnected already.
+            pass
+
+    def _send_all(self, data: bytes):
+        # the socket is non blocking so a single `send` may only take part of
+        # the data when the peer is slow to read.
+        view = memoryview(data)
+        deadline = time() + SEND_TIMEOUT
+        while view:
+            try:
+                sent = self._socket.send(view)
+            except BlockingIOError:
+                sent = 0
+
+            view = view[sent:]
+            if not view:
+                break
+
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise TimeoutError("the peer stopped receiving")
+
+            select([], [self._socket], [], remaining)
+
+    def _mark_closed(self):
+        # a closed connection never returns anything again so the buffers can be
+        # freed right away.
+        self._is_closed = True
+        self._recv_buf = bytearray()
+        self._recv_list.clear()
+        self._buffered_size = 0
+
 class ClientConnection(RawConnection):
-    def recv(self) -> Response | None:
-        serialized_message = self.recv_raw()
+    def recv(self, timeout: float = 0) -> Response | None:
+        serialized_message = self.recv_raw(timeout)
         if serialized_message is None:
             return None
         
-        return json.loads(serialized_message)
+        return deserialize(serialized_message)
 
     def send(self, message: Request):
-        serialized_message = json.dumps(message)
-        self.send_raw(serialized_message.encode())
+        self.send_raw(serialize(message))
 
 class ServerConnection(RawConnection):
-    def recv(self) -> Request | None:
-        serialized_message = self.recv_raw()
+    def recv(self, timeout: float = 0) -> Request | None:
+        serialized_message = self.recv_raw(timeout)
         if serialized_message is None:
             return None
         
-        return json.loads(serialized_message)
+        return deserialize(serialized_message)
 
     def send(self, message: Response):
-        serialized_message = json.dumps(message)
-        self.send_raw(serialized_message.encode())
+        self.send_raw(serialize(message))
 
 # Waits for clients to join the server.
 #
@@ -104,35 +292,55 @@ class ServerListener:
         self._socket.bind(("0.0.0.0", SERVER_PORT))
         self._socket.listen()
 
-    def accept(self) -> ServerConnection | None:
+    def fileno(self) -> int:
+        """
+        The file descriptor of the socket. This makes the listener usable with
+        `select`.
+        """
+
+        return self._socket.fileno()
+
+    def accept(self, timeout: float = 0) -> ServerConnection | None:
         """
         Accepts a connection if one is waiting.
 
-        Does not block if theres no connection. 
+        Waits up to `timeout` seconds for a connection. The default of 0 does
+        not block if theres no connection.
         """
 
-        conn_is_waiting, _, _ = select([self._socket], [], [], timeout=0)
+        conn_is_waiting, _, _ = select([self._socket], [], [], timeout)
         if not conn_is_waiting:
             return None
         
         conn, _ = self._socket.accept()
+        _enable_keepalive(conn)
         return ServerConnection(conn)
 
-def try_connect_to_server() -> ClientConnection | None:
+def _enable_keepalive(s: socket):
+    s.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+    # without these the system defaults apply, which usually wait hours before
+    # the first probe. Not every system has them.
+    options = (
+        ("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+        ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+        ("TCP_KEEPCNT", KEEPALIVE_COUNT),
+    )
+    for name, value in options:
+        option = getattr(socket_module, name, None)
+        if option is not None:
+            s.setsockopt(IPPROTO_TCP, option, value)
+
+def try_connect_to_server(timeout: float = 5.0) -> ClientConnection | None:
     """
     Returns a connection to the server if possible.
+
+    Gives up and returns `None` if the server didn't accept the connection
+    within `timeout` seconds. To keep trying, see `lib.client`.
     """
 
-    s = socket()
-    s.setblocking(False)
+    try:
+        s = create_connection((SERVER_IP, SERVER_PORT), timeout=timeout)
+    except OSError:
+        return None
 
-    start_time = time()
-    while True:
-        try:
-            s.connect((SERVER_IP, SERVER_PORT))
-            return ClientConnection(s)
-        except:
-            sleep(0.001)
-            continue
-    
-    return None
+    return ClientConnection(s)
@@ -0,0 +1,125 @@
+from select import select
+from threading import Lock
+from time import time
+from typing import TYPE_CHECKING
+
+from .email import Email
+from .request_response import NewMessagesNotification
+
+if TYPE_CHECKING:
+    # `request_handler` uses this module.
+    from .request_handler import Client
+
+# The shortest time in seconds between two notifications to the same
+# subscriber. Messages that arrive in between are reported together.
+NOTIFY_INTERVAL = 0.05
+
+class SubscriptionHub:
+    """
+    Keeps track of the connections that want to be told when messages are sent
+    to their user (see `SubscribeRequest`).
+
+    `notify` only counts the new messages. The notifications are sent by
+    `flush`, at most one every `notify_interval` seconds per subscriber, so a
+    burst of messages is reported by a few notifications no matter how often
+    `flush` is called. A subscriber that isn't reading doesn't slow anyone
+    down: its notifications stay as a counter until its socket has room again.
+
+    `subscribe`, `unsubscribe` and `notify` can be called from any thread.
+    `flush` should only be called from the server's main thread.
+    """
+
+    _lock: Lock
+    _subscribers: dict[str, set['Client']]
+    _emails: dict['Client', str]
+    # subscribers that have messages they weren't notified about yet, and how
+    # many.
+    _pending: dict['Client', int]
+    # when each subscriber was last notified.
+    _last_sent: dict['Client', float]
+    _notify_interval: float
+
+    def __init__(self, notify_interval: float = NOTIFY_INTERVAL):
+        self._lock = Lock()
+        self._subscribers = {}
+        self._emails = {}
+        self._pending = {}
+        self._last_sent = {}
+        self._notify_interval = notify_interval
+
+    def subscribe(self, client: 'Client', email: Email):
+        with self._lock:
+            self._remove(client)
+            self._subscribers.setdefault(email.string, set()).add(client)
+            self._emails[client] = email.string
+            client.is_subscribed = True
+
+    def unsubscribe(self, client: 'Client'):
+        """
+        Stops notifying a client. Does nothing if the client isn't subscribed.
+        """
+
+        with self._lock:
+            self._remove(client)
+
+    def notify(self, email: Email):
+        """
+        Records that a message was sent to a user.
+        """
+
+        with self._lock:
+            for client in self._subscribers.get(email.string, ()):
+                self._pending[client] = self._pending.get(client, 0) + 1
+
+    def flush(self) -> int:
+        """
+        Sends a notification to every subscriber that has new messages, wasn't
+        notified in the last `notify_interval` seconds and can take it right
+        now. Returns the amount of sent notifications.
+        """
+
+        now = time()
+        with self._lock:
+            candidates = [
+                client
+                for client in self._pending
+                if not client.is_busy
+                and not client.conn.is_closed
+                and now - self._last_sent.get(client, 0.0) >= self._notify_interval
+            ]
+        if not candidates:
+            return 0
+
+        by_conn = {id(client.conn): client for client in candidates}
+        _, writable, _ = select([], [client.conn for client in candidates], [], 0)
+
+        sent = 0
+        for conn in writable:
+            client = by_conn[id(conn)]
+            with self._lock:
+                count = self._pending.pop(client, 0)
+                if count > 0:
+                    self._last_sent[client] = now
+            if count == 0:
+                continue
+
+            try:
+                client.conn.send(NewMessagesNotification(type="NewMessagesNotification", count=count))
+                sent += 1
+            except OSError:
+                # the connection is marked as closed and will be reaped.
+                pass
+
+        return sent
+
+    def _remove(self, client: 'Client'):
+        email = self._emails.pop(client, None)
+        if email is not None:
+            subscribers = self._subscribers[email]
+            subscribers.discard(client)
+            if not subscribers:
+                del self._subscribers[email]
+
+        self._pending.pop(client, None)
+        self._last_sent.pop(client, None)
+        client.is_subscribed = False
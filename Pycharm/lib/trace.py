@@ -0,0 +1,165 @@
+import base64
+import hmac
+import json
+import os
+import struct
+from dataclasses import dataclass, fields
+from datetime import datetime
+from hashlib import sha256
+from threading import Lock
+from typing import BinaryIO, Iterator
+
+from .request_response import CreateItemResponse, Request, Response, deserialize
+
+# The start of every trace file.
+TRACE_MAGIC = b"SPTRACE2"
+# The header of every record: time since the trace started (float64 seconds),
+# connection ID (uint32), time the server took to respond (float32 seconds) and
+# the size of the payload that follows (uint32). The payload is a JSON object
+# with the redacted request and the pseudonym of the item it created, if any.
+_RECORD_HEADER = struct.Struct(">dIfI")
+# Fields that identify users and items. They are replaced by pseudonyms that
+# stay the same within a trace.
+_PSEUDONYM_FIELDS = {"email", "target_email", "auth_key", "id"}
+
+# A single request read from a trace file. This type only contains data.
+@dataclass
+class TraceRecord:
+    # Seconds between the start of the trace and when the request was received.
+    time: float
+    # Requests from the same connection have the same ID.
+    connection_id: int
+    # Seconds between receiving the request and sending the response.
+    latency: float
+    # The request type, like "LoginRequest".
+    request_type: str
+    # The redacted request. See `TraceRecord::to_request`.
+    payload: dict
+    # The pseudonym of the item ID returned to a successful
+    # `CreateItemRequest`, otherwise None.
+    created_id: str | None
+
+    # Rebuilds a request that has the same shape as the recorded one. Byte
+    # fields are zeros of the recorded size and users are replaced by their
+    # pseudonyms. Item IDs whose pseudonym is in `ids` are replaced by the ID
+    # it maps to, so requests about items created during a replay can use the
+    # IDs the replay got (see `TraceRecord::created_id`).
+    def to_request(self, ids: dict[str, bytes] | None = None) -> Request:
+        value = {name: _unredact(v, ids or {}) for name, v in self.payload.items()}
+        return deserialize(json.dumps(value).encode())
+
+class TraceRecorder:
+    """
+    Writes the requests received by the server to a new trace file, so they
+    can be replayed later (see `trace_replay.py`). Records are buffered, call
+    `flush` once in a while.
+
+    Nothing private is written: byte fields (encrypted contents, keys) only
+    keep their size, and emails, authentication keys and item IDs are replaced
+    by pseudonyms made with a random salt that is never saved.
+
+    `record` can be called from multiple threads at the same time.
+    """
+
+    _lock: Lock
+    _file: BinaryIO
+    _start_time: float
+    _salt: bytes
+
+    def __init__(self, path: str, start_time: float):
+        self._lock = Lock()
+        self._file = open(path, "wb", buffering=64 * 1024)
+        self._file.write(TRACE_MAGIC)
+        # times are stored relative to this.
+        self._start_time = start_time
+        self._salt = os.urandom(32)
+
+    def record(self, connection_id: int, request: Request, response: Response, received_time: float, latency: float):
+        created_id = None
+        if isinstance(response, CreateItemResponse) and response.is_success:
+            created_id = self._pseudonym(response.id)
+
+        payload = json.dumps({
+            "request": {
+                field.name: self._redact(field.name, getattr(request, field.name))
+                for field in fields(request)
+            },
+            "created_id": created_id,
+        }).encode()
+        header = _RECORD_HEADER.pack(received_time - self._start_time, connection_id, latency, len(payload))
+
+        with self._lock:
+            self._file.write(header)
+            self._file.write(payload)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def _redact(self, name: str, value):
+        if isinstance(value, bytes):
+            if name in _PSEUDONYM_FIELDS:
+                return {"size": len(value), "pseudonym": self._pseudonym(value)}
+            return {"size": len(value)}
+        if isinstance(value, list):
+            return [self._redact(name, item) for item in value]
+        if isinstance(value, datetime):
+            return value.isoformat()
+        if name in _PSEUDONYM_FIELDS:
+            digest = hmac.new(self._salt, str(value).encode(), sha256).digest()
+            if isinstance(value, int):
+                return int.from_bytes(digest)
+            return f"{digest.hex()[:16]}@trace.invalid"
+        return value
+
+    def _pseudonym(self, value: bytes) -> str:
+        return hmac.new(self._salt, value, sha256).hexdigest()[:32]
+
+def read_trace(path: str) -> Iterator[TraceRecord]:
+    """
+    Returns the records of a trace file in the order they were written.
+    """
+
+    with open(path, "rb") as file:
+        if file.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise Exception(f"{path} is not a trace file")
+
+        while True:
+            header = file.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                # a partial record is left if the server stopped while writing.
+                return
+
+            time, connection_id, latency, payload_size = _RECORD_HEADER.unpack(header)
+            payload_bytes = file.read(payload_size)
+            if len(payload_bytes) < payload_size:
+                return
+
+            payload = json.loads(payload_bytes)
+            yield TraceRecord(
+                time=time,
+                connection_id=connection_id,
+                latency=latency,
+                request_type=payload["request"]["type"],
+                payload=payload["request"],
+                created_id=payload["created_id"],
+            )
+
+def _unredact(value, ids: dict[str, bytes]):
+    if isinstance(value, dict):
+        # `deserialize` expects bytes in base64.
+        if value.get("pseudonym") in ids:
+            return base64.b64encode(ids[value["pseudonym"]]).decode()
+        return _zeros_base64(value["size"])
+    if isinstance(value, list):
+        return [_unredact(item, ids) for item in value]
+    return value
+
+def _zeros_base64(size: int) -> str:
+    # base64 turns every 3 zero bytes into "AAAA".
+    full, rest = divmod(size, 3)
+    return "AAAA" * full + ("", "AA==", "AAA=")[rest]
@@ -1,25 +1,130 @@
-from time import sleep
+import os
+import shutil
+import signal
 from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from threading import Lock, Thread
+from time import time
 
 from lib.socket_wrapper import ServerListener
 from lib.request_handler import Client, handle_next_request
+from lib.connection_manager import ConnectionManager
+from lib.database import Database
+from lib.subscriptions import SubscriptionHub
+from lib.maintenance import DatabaseMaintenance
+from lib.trace import TraceRecorder
 
+SCRIPT_DIR = Path(__file__).resolve().parent
+DATA_DIR = Path(f"{SCRIPT_DIR}/data")
+BACKUPS_DIR = Path(f"{SCRIPT_DIR}/backups")
+
+DATA_DIR.mkdir(parents=True, exist_ok=True)
+db = Database(DATA_DIR.__str__())
+subscriptions = SubscriptionHub()
 listener = ServerListener()
-clients = []
+connections = ConnectionManager(listener, on_remove=subscriptions.unsubscribe)
+
+# Seconds between printing how many clients are connected.
+CONNECTIONS_REPORT_INTERVAL = 10.0 * 60.0
+next_connections_report = 0.0
+
+# Seconds without requests after which the server counts as idle.
+IDLE_DELAY = 1.0
+# requests that were given to a worker and didn't finish yet, and when the last
+# one started or finished.
+requests_lock = Lock()
+requests_in_flight = 0
+last_request_time = 0.0
+
+def is_idle() -> bool:
+    with requests_lock:
+        return requests_in_flight == 0 and time() - last_request_time > IDLE_DELAY
+
+maintenance = DatabaseMaintenance(db, is_idle=is_idle)
+maintenance.start()
+
+# Setting this environment variable to a path records the requests the server
+# gets into that file, to be replayed by `trace_replay.py`.
+TRACE_FILE = os.environ.get("SERVER_TRACE_FILE")
+recorder = TraceRecorder(TRACE_FILE, time()) if TRACE_FILE else None
+
+# Creating this file starts a backup, on every system. The file is deleted
+# once the backup starts.
+BACKUP_TRIGGER_FILE = Path(f"{SCRIPT_DIR}/backup.request")
+# Seconds between checking whether `BACKUP_TRIGGER_FILE` exists.
+BACKUP_TRIGGER_INTERVAL = 1.0
+next_backup_trigger_check = 0.0
+
+backup_thread: Thread | None = None
+
+# Backs up the database into a new directory in `BACKUPS_DIR` on a background
+# thread while the server keeps running. This is triggered by creating
+# `BACKUP_TRIGGER_FILE`, and on systems that have `SIGUSR1` also by
+# `kill -USR1 <server pid>`.
+def start_backup(*_):
+    global backup_thread
+    if backup_thread is not None and backup_thread.is_alive():
+        print("backup: already running")
+        return
+
+    target_dir = Path(f"{BACKUPS_DIR}/{datetime.now():%Y-%m-%d_%H-%M-%S}")
+    target_dir.mkdir(parents=True, exist_ok=True)
+    last_percent = -1
+
+    def report(copied: int, total: int):
+        nonlocal last_percent
+        percent = copied * 100 // total if total else 100
+        if percent // 10 != last_percent // 10:
+            print(f"backup: {percent}% ({copied}/{total} pages)")
+        last_percent = percent
+
+    def run():
+        try:
+            db.backup(target_dir.__str__(), progress=report)
+            print(f"backup: done, saved to {target_dir}")
+        except Exception as e:
+            # `Database::backup` already removed the partial copy.
+            shutil.rmtree(target_dir, ignore_errors=True)
+            print(f"backup: failed, {e}")
+
+    backup_thread = Thread(target=run, daemon=True)
+    backup_thread.start()
+
+if hasattr(signal, "SIGUSR1"):
+    signal.signal(signal.SIGUSR1, start_backup)
+
+def handle_and_release(client: Client):
+    global requests_in_flight, last_request_time
+    try:
+        handle_next_request(client, db, subscriptions, recorder)
+    finally:
+        with requests_lock:
+            requests_in_flight -= 1
+            last_request_time = time()
+        client.is_busy = False
+        connections.wake()
 
 with ThreadPoolExecutor(max_workers=10) as thread_pool:
     while True:
-        for _ in range(50):
-            conn = listener.accept()
-            if conn == None:
-                break
-            
-            clients.append(Client(conn))
+        for client in connections.poll(timeout=0.05):
+            client.is_busy = True
+            with requests_lock:
+                requests_in_flight += 1
+                last_request_time = time()
+            thread_pool.submit(handle_and_release, client)
 
-        for client in clients:
-            if not client.conn.has_input():
-                continue
+        subscriptions.flush()
+        if recorder is not None:
+            recorder.flush()
+        connections.reap()
 
-            thread_pool.submit(handle_next_request, client)
+        if time() >= next_backup_trigger_check:
+            if BACKUP_TRIGGER_FILE.exists():
+                BACKUP_TRIGGER_FILE.unlink(missing_ok=True)
+                start_backup()
+            next_backup_trigger_check = time() + BACKUP_TRIGGER_INTERVAL
 
-        sleep(0.001)
+        if time() >= next_connections_report:
+            print(f"connections: {len(connections)} clients, {connections.buffered_size} bytes buffered")
+            next_connections_report = time() + CONNECTIONS_REPORT_INTERVAL
@@ -0,0 +1,470 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from socket import SOL_SOCKET, SO_KEEPALIVE
+from threading import Event, Thread
+from time import sleep, time
+from uuid import uuid4
+
+from lib import socket_wrapper
+from lib.socket_wrapper import ServerListener, try_connect_to_server
+from lib.connection_manager import ConnectionManager
+from lib.client import ConnectionPool, ServerClient
+from lib.email import Email
+from lib.database import Database
+from lib.request_handler import Client, handle_next_request
+from lib.subscriptions import SubscriptionHub
+from lib.trace import TraceRecorder, read_trace
+from lib.request_response import (
+    FetchRequest,
+    FetchResponse,
+    LoginRequest,
+    PushRequest,
+    CreateItemRequest,
+    CreateItemResponse,
+    ItemRequest,
+    SendRequest,
+    ReleaseItemRequest,
+    serialize,
+    deserialize,
+)
+
+def assert_panic(f):
+    try:
+        f()
+    except:
+        return
+    raise RuntimeError("Function did not panic")
+
+def assert_eq(a, b):
+    if a != b:
+        raise RuntimeError(f"{a} != {b}")
+
+# the listener takes any free port so the tests don't collide with a server.
+socket_wrapper.SERVER_IP = "127.0.0.1"
+socket_wrapper.SERVER_PORT = 0
+listener = ServerListener()
+socket_wrapper.SERVER_PORT = listener._socket.getsockname()[1]
+
+def connect():
+    conn = try_connect_to_server()
+    assert_eq(conn is None, False)
+    return conn
+
+def poll_until(manager: ConnectionManager, f):
+    # the server side of the sockets may need a moment to see what was sent.
+    for _ in range(100):
+        ready = manager.poll(timeout=0.01)
+        if f(ready):
+            return ready
+    raise RuntimeError("Condition wasn't met")
+
+# accepted connections probe the peer so a vanished peer is noticed.
+conn = connect()
+server_conn = listener.accept(1)
+assert_eq(server_conn._socket.getsockopt(SOL_SOCKET, SO_KEEPALIVE) != 0, True)
+server_conn.close()
+conn.close()
+
+# connections over the limit are refused.
+manager = ConnectionManager(listener, max_connections=2)
+conns = [connect() for _ in range(3)]
+poll_until(manager, lambda _: len(manager) == 2)
+sleep(0.05)
+assert_eq(manager.accept_all(), 0)
+assert_eq(len(manager), 2)
+assert_eq(sum(conn.wait_for_message(0.5) or conn.is_closed for conn in conns), 1)
+
+# whole requests are returned, parts of requests aren't.
+open_conns = [conn for conn in conns if not conn.is_closed]
+open_conns[0].send(FetchRequest(type="FetchRequest"))
+open_conns[1]._socket.send(b"\0\0\0\x20{")
+ready = poll_until(manager, lambda ready: len(ready) > 0)
+assert_eq(len(ready), 1)
+assert_eq(ready[0].conn.recv(), FetchRequest(type="FetchRequest"))
+
+# busy clients are never returned.
+open_conns[0].send(FetchRequest(type="FetchRequest"))
+ready[0].is_busy = True
+sleep(0.05)
+assert_eq(manager.poll(timeout=0.01), [])
+ready[0].is_busy = False
+assert_eq(len(poll_until(manager, lambda ready: len(ready) > 0)), 1)
+
+# disconnected clients are removed.
+open_conns[0].close()
+poll_until(manager, lambda _: len(manager) == 1)
+
+# idle clients are reaped, busy ones aren't.
+manager._idle_timeout = 0
+for client in manager._clients.values():
+    client.is_busy = True
+assert_eq(manager.reap(), 0)
+for client in manager._clients.values():
+    client.is_busy = False
+sleep(0.01)
+assert_eq(manager.reap(), 1)
+assert_eq(len(manager), 0)
+for conn in conns:
+    conn.close()
+
+# clients that hold the most received bytes are removed when all of them
+# together hold too much. Both send the start of a 4096 byte request.
+manager = ConnectionManager(listener, max_total_buffered_size=1000)
+small = connect()
+large = connect()
+poll_until(manager, lambda _: len(manager) == 2)
+small._socket.send(b"\0\0\x10\0" + b"a" * 400)
+poll_until(manager, lambda _: manager.buffered_size == 404)
+large._socket.send(b"\0\0\x10\0" + b"a" * 800)
+poll_until(manager, lambda _: len(manager) == 1)
+assert_eq(manager.buffered_size, 404)
+assert_eq(large.wait_for_message(0.5), False)
+assert_eq(large.is_closed, True)
+small.close()
+large.close()
+
+# a client whose socket was closed without `remove` is removed when its file
+# descriptor is given to a new connection.
+removed = []
+manager = ConnectionManager(listener, on_remove=removed.append)
+first = connect()
+poll_until(manager, lambda _: len(manager) == 1)
+old_client = list(manager._clients.values())[0]
+# the new connection waits to be accepted until the old socket is closed.
+second = connect()
+old_client.conn.close()
+poll_until(manager, lambda _: len(removed) == 1)
+assert_eq(removed, [old_client])
+assert_eq(len(manager), 1)
+assert_eq(list(manager._clients.values())[0].conn.is_closed, False)
+
+# `shutdown` disconnects the peer but keeps the file descriptor until `remove`.
+new_client = list(manager._clients.values())[0]
+new_client.conn.shutdown()
+assert_eq(second.wait_for_message(0.5), False)
+assert_eq(second.is_closed, True)
+assert_eq(manager._clients.get(new_client.fd), new_client)
+assert_eq(manager.reap(), 1)
+assert_eq(removed, [old_client, new_client])
+first.close()
+second.close()
+
+# `wake` makes a waiting `poll` return right away.
+manager.wake()
+start = time()
+assert_eq(manager.poll(timeout=5), [])
+assert_eq(time() - start < 1, True)
+
+# messages keep every field after being sent.
+messages = [
+    FetchRequest(type="FetchRequest"),
+    PushRequest(type="PushRequest", private_info=bytes(range(256)), messages=[b"", b"hello", b"\0\1\2"]),
+    ReleaseItemRequest(
+        type="ReleaseItemRequest",
+        id=uuid4().bytes,
+        auth_key=2 ** 255,
+        info=b"esyrgiouhio3uhio4hafsiouhi456wuhszdhfgiouhw45tiosdfgesrtg",
+        expires=datetime(2030, 1, 2, 3, 4, 5, 6789),
+    ),
+    FetchResponse(
+        type="FetchResponse",
+        private_info=b"",
+        messages=[b"gerijgterio"],
+        user_emails=["yarden@cohen.com", "yarden@kohen.com"],
+        user_descriptions=["", "The second user"],
+        user_public_keys=[bytes(32), b"\xff" * 32],
+    ),
+]
+for message in messages:
+    assert_eq(deserialize(serialize(message)), message)
+
+assert_panic(lambda: deserialize(b"{}"))
+assert_panic(lambda: deserialize(b'{"type": "NotARequest"}'))
+assert_panic(lambda: deserialize(b'{"type": "PushRequest", "private_info": ""}'))
+
+# connections that the server closed while they were in the pool aren't
+# reused.
+pool = ConnectionPool(max_size=1)
+conn = pool.acquire(1)
+server_conn = listener.accept(1)
+pool.release(conn)
+server_conn.close()
+sleep(0.05)
+new_conn = pool.acquire(1)
+assert_eq(new_conn is conn, False)
+assert_eq(conn.is_closed, True)
+server_conn = listener.accept(1)
+
+# a request on a connection that is closed before the response arrives is
+# tried once more on a new connection.
+def serve_after_closing_once():
+    listener.accept(1).close()
+    server_conn = listener.accept(1)
+    server_conn.recv(1)
+    server_conn.send(FetchResponse(
+        type="FetchResponse",
+        private_info=b"",
+        messages=[],
+        user_emails=[],
+        user_descriptions=[],
+        user_public_keys=[],
+    ))
+    server_conn.close()
+
+client = ServerClient(ConnectionPool(max_size=1), timeout=2)
+thread = Thread(target=serve_after_closing_once)
+thread.start()
+assert_eq(client.fetch().user_emails, [])
+thread.join()
+
+# the second failure is reported as a lost connection instead of a timeout.
+def close_twice():
+    listener.accept(1).close()
+    listener.accept(1).close()
+
+thread = Thread(target=close_twice)
+thread.start()
+start = time()
+try:
+    client.fetch()
+    raise RuntimeError("Function did not panic")
+except ConnectionError:
+    pass
+assert_eq(time() - start < 1, True)
+thread.join()
+
+# requests that change something aren't sent again once the server may have
+# received them.
+def close_after_receiving():
+    server_conn = listener.accept(1)
+    server_conn.recv(1)
+    server_conn.close()
+
+thread = Thread(target=close_after_receiving)
+thread.start()
+assert_panic(lambda: client.send("yarden@cohen.com", b"hello"))
+thread.join()
+assert_eq(listener.accept(0.2), None)
+
+# a closed pool closes connections when they are released and doesn't make
+# new ones.
+pool.close()
+pool.release(new_conn)
+assert_eq(new_conn.is_closed, True)
+assert_panic(lambda: pool.acquire(1))
+client.close()
+server_conn.close()
+
+# a burst of messages is reported by a few notifications even when `flush` is
+# called after every message.
+hub = SubscriptionHub(notify_interval=0.2)
+subscriber_conn = connect()
+subscriber = Client(listener.accept(1))
+hub.subscribe(subscriber, Email("yarden@cohen.com"))
+assert_eq(subscriber.is_subscribed, True)
+for _ in range(20):
+    hub.notify(Email("yarden@cohen.com"))
+    hub.notify(Email("yarden@kohen.com"))
+    hub.flush()
+    sleep(0.005)
+sleep(0.2)
+hub.flush()
+
+counts = []
+notification = subscriber_conn.recv(0.5)
+while notification is not None:
+    counts.append(notification.count)
+    notification = subscriber_conn.recv(0.1)
+assert_eq(sum(counts), 20)
+assert_eq(len(counts) <= 3, True)
+
+# busy subscribers keep their count until they aren't busy.
+hub.notify(Email("yarden@cohen.com"))
+subscriber.is_busy = True
+assert_eq(hub.flush(), 0)
+subscriber.is_busy = False
+sleep(0.2)
+assert_eq(hub.flush(), 1)
+assert_eq(subscriber_conn.recv(0.5).count, 1)
+
+# unsubscribed clients aren't notified.
+hub.unsubscribe(subscriber)
+assert_eq(subscriber.is_subscribed, False)
+hub.notify(Email("yarden@cohen.com"))
+sleep(0.2)
+assert_eq(hub.flush(), 0)
+subscriber.conn.close()
+subscriber_conn.close()
+
+# traces keep the shape of requests but not what's private in them.
+trace_path = os.path.join(tempfile.mkdtemp(), "trace")
+recorder = TraceRecorder(trace_path, start_time=100.0)
+expires = datetime(2030, 1, 2, 3, 4, 5)
+created_id = uuid4().bytes
+recorded = [
+    (LoginRequest(type="LoginRequest", email="yarden@cohen.com", auth_key=47584093698567567586), None),
+    (SendRequest(type="SendRequest", target_email="yarden@kohen.com", content=b"helloworld"), None),
+    (LoginRequest(type="LoginRequest", email="yarden@cohen.com", auth_key=47584093698567567586), None),
+    (PushRequest(type="PushRequest", private_info=b"abc", messages=[b"gerijgterio", b""]), None),
+    (ReleaseItemRequest(type="ReleaseItemRequest", id=uuid4().bytes, auth_key=1, info=b"info", expires=expires), None),
+    (
+        CreateItemRequest(type="CreateItemRequest", contents=b"contents", auth_key=1),
+        CreateItemResponse(type="CreateItemResponse", is_success=True, id=created_id),
+    ),
+    (ItemRequest(type="ItemRequest", id=created_id, auth_key=1), None),
+    (
+        CreateItemRequest(type="CreateItemRequest", contents=b"contents", auth_key=1),
+        CreateItemResponse(type="CreateItemResponse", is_success=False, id=b""),
+    ),
+]
+for i, (request, response) in enumerate(recorded):
+    recorder.record(i % 2, request, response, received_time=100.0 + i, latency=0.5)
+recorder.close()
+
+records = list(read_trace(trace_path))
+assert_eq([record.request_type for record in records], [request.type for request, _ in recorded])
+assert_eq([record.time for record in records], [0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0])
+assert_eq([record.connection_id for record in records], [0, 1, 0, 1, 0, 1, 0, 1])
+assert_eq([record.latency for record in records], [0.5] * 8)
+
+# bytes only keep their size.
+assert_eq(records[1].payload["content"], {"size": 10})
+assert_eq(records[3].payload["messages"], [{"size": 11}, {"size": 0}])
+assert_eq(records[3].to_request(), PushRequest(type="PushRequest", private_info=bytes(3), messages=[bytes(11), bytes(0)]))
+assert_eq(records[4].to_request().expires, expires)
+
+# users are replaced by the same pseudonyms every time.
+login1, login2 = records[0].to_request(), records[2].to_request()
+assert_eq(login1, login2)
+assert_eq("yarden" in login1.email, False)
+assert_eq(login1.auth_key != 47584093698567567586, True)
+assert_eq(records[1].to_request().target_email != login1.email, True)
+
+# item IDs are pseudonyms too, and the ID a request created can be replaced by
+# the one a replay got.
+assert_eq(records[5].created_id, records[6].payload["id"]["pseudonym"])
+assert_eq(records[4].payload["id"]["pseudonym"] != records[5].created_id, True)
+assert_eq(records[7].created_id, None)
+assert_eq(records[6].to_request().id, bytes(16))
+replayed_id = uuid4().bytes
+assert_eq(records[6].to_request({records[5].created_id: replayed_id}).id, replayed_id)
+assert_eq(records[4].to_request({records[5].created_id: replayed_id}).id, bytes(16))
+with open(trace_path, "rb") as trace_file:
+    trace_data = trace_file.read()
+assert_eq(b"yarden" in trace_data or b"helloworld" in trace_data, False)
+assert_eq(created_id.hex().encode() in trace_data, False)
+os.remove(trace_path)
+os.rmdir(os.path.dirname(trace_path))
+
+# a server like the one in `server.py`, with its own database, running on a
+# thread.
+server_data_dir = tempfile.mkdtemp()
+server_db = Database(server_data_dir)
+server_subscriptions = SubscriptionHub()
+server_connections = ConnectionManager(listener, on_remove=server_subscriptions.unsubscribe)
+server_stop = Event()
+
+def handle_and_release(client: Client):
+    try:
+        handle_next_request(client, server_db, server_subscriptions)
+    finally:
+        client.is_busy = False
+        server_connections.wake()
+
+def run_server():
+    with ThreadPoolExecutor(max_workers=4) as workers:
+        while not server_stop.is_set():
+            for client in server_connections.poll(timeout=0.05):
+                client.is_busy = True
+                workers.submit(handle_and_release, client)
+
+            server_subscriptions.flush()
+            server_connections.reap()
+
+# a daemon so a failed assertion doesn't leave the script running.
+server_thread = Thread(target=run_server, daemon=True)
+server_thread.start()
+
+alice = ServerClient(timeout=5)
+bob = ServerClient(timeout=5)
+assert_eq(alice.signup("alice@cohen.com", 1, bytes(32)).is_succees, True)
+assert_eq(alice.signup("alice@cohen.com", 1, bytes(32)).email_is_taken, True)
+assert_eq(bob.signup("bob@cohen.com", 2, b"\1" * 3).is_succees, False)
+assert_eq(bob.signup("bob@cohen.com", 2, b"\1" * 32).is_succees, True)
+assert_eq(alice.login("alice@cohen.com", 2).password_is_correct, False)
+assert_eq(alice.login("alice@cohen.com", 1).is_succees, True)
+assert_eq(bob.login("bob@cohen.com", 2).is_succees, True)
+
+# messages sent to a subscribed user are announced on the subscription.
+subscription = alice.subscribe()
+assert_eq(subscription.wait(0.1), 0)
+assert_eq(bob.send("alice@cohen.com", b"first").is_succees, True)
+assert_eq(bob.send("alice@cohen.com", b"second").is_succees, True)
+assert_eq(bob.send("nobody@cohen.com", b"lost").is_succees, False)
+new_message_count = 0
+while new_message_count < 2:
+    count = subscription.wait(2)
+    assert_eq(count > 0, True)
+    new_message_count += count
+assert_eq(new_message_count, 2)
+
+fetched = alice.fetch()
+assert_eq(fetched.messages, [b"first", b"second"])
+assert_eq(fetched.user_emails, ["alice@cohen.com", "bob@cohen.com"])
+assert_eq(fetched.user_public_keys, [bytes(32), b"\1" * 32])
+
+assert_eq(alice.push(b"private", [b"first"]).is_succees, True)
+fetched = alice.fetch()
+assert_eq((fetched.private_info, fetched.messages), (b"private", [b"first"]))
+assert_eq(alice.get_private_info_range(1, 3).private_info, b"riv")
+assert_eq(alice.write_private_info_range(0, b"P").is_success, True)
+assert_eq(alice.get_private_info_range(0, 7).private_info, b"Private")
+out_of_range = alice.get_private_info_range(5, 10)
+assert_eq((out_of_range.out_of_range, out_of_range.size), (True, 7))
+
+id = bob.create_item(b"contents", 3).id
+assert_eq(bob.get_item(id, 3).contents, b"contents")
+assert_eq(bob.get_item(id, 4).wrong_key, True)
+item_range = bob.get_item_range(id, 3, 3, 4)
+assert_eq((item_range.contents, item_range.size), (b"tent", 8))
+assert_eq(bob.get_item_range(id, 4, 3, 4).wrong_key, True)
+# the auth key was already checked on the connection so it isn't hashed again.
+start = time()
+for _ in range(10):
+    assert_eq(bob.get_item_range(id, 3, 0, 1).contents, b"c")
+assert_eq(time() - start < 0.5, True)
+assert_eq(bob.write_item_range(id, 3, 0, b"C").is_success, True)
+assert_eq(bob.append_item(id, 3, b"!").is_success, True)
+assert_eq(bob.get_item(id, 3).contents, b"Contents!")
+out_of_range = bob.get_item_range(id, 3, 5, 10)
+assert_eq((out_of_range.out_of_range, out_of_range.size), (True, 9))
+assert_eq(bob.encrypt_item(id, 4, bytes(32), b"").wrong_key, True)
+assert_eq(bob.encrypt_item(id, 3, bytes(32), b"").is_success, False)
+assert_eq(bob.get_item(id, 3).contents, b"Contents!")
+assert_eq(bob.release_item(id, 3, b"info", datetime(2030, 1, 1)).is_success, True)
+assert_eq(bob.get_item(id, 3).release_key_contents, [b"info"])
+
+# clients that didn't log in can't use the requests of a user.
+stranger = ServerClient(timeout=5)
+assert_eq(stranger.fetch().messages, [])
+assert_eq(stranger.push(b"", []).is_succees, False)
+assert_eq(stranger.send("alice@cohen.com", b"hello").is_succees, False)
+assert_eq(stranger.get_private_info_range(0, 1).is_success, False)
+
+# closing a subscription unsubscribes it on the server.
+subscription.close()
+for _ in range(100):
+    if not server_subscriptions._emails:
+        break
+    sleep(0.01)
+assert_eq(server_subscriptions._emails, {})
+
+alice.close()
+bob.close()
+stranger.close()
+server_stop.set()
+server_thread.join()
+shutil.rmtree(server_data_dir)
@@ -1,14 +1,8 @@
-from .lib.socket_wrapper import ClientConnection, try_connect_to_server
-from .lib.request_response import LoginRequest, LoginResponse
+from lib.client import ServerClient
+from lib.request_response import LoginResponse
 
-conn = try_connect_to_server()
-while conn is None:
-    conn = try_connect_to_server()
+client = ServerClient()
 
-conn.send(LoginRequest(auth_key=5430897456,email="yarden.cohen@america.us"))
+recv = client.login(auth_key=5430897456,email="yarden.cohen@america.us")
 
-recv = conn.recv()
-while recv is None:
-    recv = conn.recv()
-
-assert recv == LoginResponse(is_succees=True,password_is_correct=True)
+assert recv == LoginResponse(type="LoginResponse",is_succees=True,password_is_correct=True)
@@ -1,19 +1,16 @@
-from .lib.socket_wrapper import ServerListener, ServerConnection
-from .lib.request_response import LoginRequest, LoginResponse
+from lib.socket_wrapper import ServerListener, ServerConnection
+from lib.request_response import LoginRequest, LoginResponse
 
 listener = ServerListener()
 
-conn = listener.accept()
-while conn is None:
-    conn = listener.accept()
+conn = listener.accept(timeout=60)
+assert conn is not None
 
-recv = conn.recv()
-while recv is None:
-    recv = conn.recv()
+recv = conn.recv(timeout=60)
 
-assert recv == LoginRequest(auth_key=5430897456,email="yarden.cohen@america.us")
+assert recv == LoginRequest(type="LoginRequest",auth_key=5430897456,email="yarden.cohen@america.us")
 
-conn.send(LoginResponse(is_succees=True,password_is_correct=True))
+conn.send(LoginResponse(type="LoginResponse",is_succees=True,password_is_correct=True))
 
 
 
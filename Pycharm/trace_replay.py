@@ -0,0 +1,119 @@
+import argparse
+from threading import Thread
+from time import perf_counter, sleep
+
+from lib import socket_wrapper
+from lib.socket_wrapper import try_connect_to_server
+from lib.request_response import CreateItemResponse, NewMessagesNotification, Response
+from lib.trace import TraceRecord, read_trace
+
+# Replays a trace recorded by the server (see `SERVER_TRACE_FILE` in
+# `server.py`) against a server, then compares the latency of every request type
+# to the latency that was recorded.
+#
+# Every recorded connection gets its own connection and thread, and sends its
+# requests at the recorded times divided by `--speed`. `--speed 0` sends every
+# request as soon as the previous response on the same connection arrived.
+#
+# The recorded latency is the time the server took to respond, while the
+# replayed latency also includes the network, so a local server should be used.
+#
+# The trace doesn't contain the real data, so requests about users and items
+# that weren't created during the trace usually fail. Items created during the
+# trace are used by the IDs the replay got for them, as long as the request
+# that created them was answered first. Failed responses are counted
+# separately and left out of the latencies, since they are usually much faster.
+
+RESPONSE_TIMEOUT = 30.0
+
+# A replayed request: its type, the recorded latency, the replayed latency and
+# whether the replayed response was successful.
+Result = tuple[str, float, float, bool]
+
+def replay_connection(records: list[TraceRecord], start: float, speed: float, ids: dict[str, bytes], results: list[Result]):
+    conn = try_connect_to_server()
+    if conn is None:
+        print(f"connection {records[0].connection_id}: couldn't connect")
+        return
+
+    for record in records:
+        if speed > 0:
+            delay = start + record.time / speed - perf_counter()
+            if delay > 0:
+                sleep(delay)
+
+        # built after waiting, so IDs created by other connections meanwhile
+        # are used.
+        request = record.to_request(ids)
+        send_time = perf_counter()
+        conn.send(request)
+        response = conn.recv(RESPONSE_TIMEOUT)
+        # subscribed connections also get notifications that aren't responses.
+        while isinstance(response, NewMessagesNotification):
+            response = conn.recv(RESPONSE_TIMEOUT)
+        if response is None:
+            print(f"connection {record.connection_id}: no response to {record.request_type}")
+            break
+
+        latency = perf_counter() - send_time
+        if record.created_id is not None and isinstance(response, CreateItemResponse) and response.is_success:
+            ids[record.created_id] = response.id
+        results.append((record.request_type, record.latency, latency, is_success(response)))
+
+    conn.close()
+
+# Responses without a success field, like `FetchResponse`, always succeed.
+def is_success(response: Response) -> bool:
+    # some responses spell it `is_succees`.
+    return getattr(response, "is_success", getattr(response, "is_succees", True))
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def print_report(results: list[Result]):
+    print(f"{'request':<30} {'count':>6} {'failed':>6} {'recorded p50':>13} {'replayed p50':>13} {'recorded p95':>13} {'replayed p95':>13}")
+    for request_type in sorted({result[0] for result in results}):
+        succeeded = [result for result in results if result[0] == request_type and result[3]]
+        failed = sum(1 for result in results if result[0] == request_type and not result[3])
+        if not succeeded:
+            print(f"{request_type:<30} {failed:>6} {failed:>6}")
+            continue
+
+        recorded = [result[1] for result in succeeded]
+        replayed = [result[2] for result in succeeded]
+        print(
+            f"{request_type:<30} {len(succeeded) + failed:>6} {failed:>6} "
+            f"{percentile(recorded, 0.5) * 1000:>10.2f} ms {percentile(replayed, 0.5) * 1000:>10.2f} ms "
+            f"{percentile(recorded, 0.95) * 1000:>10.2f} ms {percentile(replayed, 0.95) * 1000:>10.2f} ms"
+        )
+
+parser = argparse.ArgumentParser(description="Replays a trace recorded by the server.")
+parser.add_argument("trace", help="the trace file")
+parser.add_argument("--speed", type=float, default=1.0, help="how much faster than recorded to replay, 0 for as fast as possible")
+parser.add_argument("--ip", default="127.0.0.1", help="the server to replay against")
+args = parser.parse_args()
+
+socket_wrapper.SERVER_IP = args.ip
+
+connections: dict[int, list[TraceRecord]] = {}
+for record in read_trace(args.trace):
+    connections.setdefault(record.connection_id, []).append(record)
+
+# shared by all the connections, since items can be used by any of them.
+ids: dict[str, bytes] = {}
+results: list[Result] = []
+start = perf_counter()
+threads = [
+    Thread(target=replay_connection, args=(records, start, args.speed, ids, results))
+    for records in connections.values()
+]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+
+failed = sum(1 for result in results if not result[3])
+print(f"replayed {len(results)} requests ({failed} failed) from {len(connections)} connections in {perf_counter() - start:.2f} s")
+if results:
+    print_report(results)